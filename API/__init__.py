@@ -1,23 +1,76 @@
 from flask import Flask
 from flask_sqlalchemy import SQLAlchemy
-from flasgger import Swagger
-from os import environ
-
-app = Flask(__name__)
-app.config['SQLALCHEMY_DATABASE_URI'] = environ.get('DB_URL')
-db = SQLAlchemy(app)
-
-swagger = Swagger(app, template={
-    "swagger": "2.0",
-    "info": {
-        "title": "InventAPI",
-        "description": "An API that helps managing inventory",
-        "version": "0.1"
-    },
-    "schemes": [
-        "http"
-    ]
-})
-
-from .endpoints.endpoints import product_blueprint
-app.register_blueprint(product_blueprint)
+from flask_migrate import Migrate
+from os import environ, path
+from .database.pool import TimedQueuePool
+
+db = SQLAlchemy()
+
+# El esquema se crea con migraciones (flask db upgrade), nunca al importar la aplicación
+MIGRATIONS_DIR = path.join(path.dirname(path.dirname(path.abspath(__file__))), 'migrations')
+
+def engine_options():
+    # Pool de conexiones configurable por variables de entorno; se aplica también a la réplica de lectura
+    options = {
+        'poolclass': TimedQueuePool,
+        'pool_size': int(environ.get('DB_POOL_SIZE', 5)),
+        'max_overflow': int(environ.get('DB_MAX_OVERFLOW', 10)),
+        'pool_timeout': float(environ.get('DB_POOL_TIMEOUT', 30)),
+        'pool_recycle': int(environ.get('DB_POOL_RECYCLE', 1800)),
+        'pool_pre_ping': environ.get('DB_POOL_PRE_PING', '1').lower() in ('1', 'true', 'yes')
+    }
+    if environ.get('DB_STATEMENT_TIMEOUT'):
+        options['connect_args'] = {'options': f"-c statement_timeout={int(environ['DB_STATEMENT_TIMEOUT'])}"}
+    return options
+
+def create_app():
+    app = Flask(__name__)
+    app.config['SQLALCHEMY_DATABASE_URI'] = environ.get('DB_URL')
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = engine_options()
+    app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+    if environ.get('DB_READ_URL'):
+        app.config['SQLALCHEMY_BINDS'] = {'read': environ['DB_READ_URL']}
+    db.init_app(app)
+
+    # Registra los comandos flask db; no toca la base de datos al arrancar
+    Migrate(app, db, directory=MIGRATIONS_DIR)
+
+    # La documentación se puede desactivar (SWAGGER_ENABLED=0); la especificación se genera en la primera visita
+    if environ.get('SWAGGER_ENABLED', '1').lower() in ('1', 'true', 'yes'):
+        from .endpoints.docs import CachedSwagger
+        CachedSwagger(app, template={
+            "swagger": "2.0",
+            "info": {
+                "title": "InventAPI",
+                "description": "An API that helps managing inventory",
+                "version": "0.1"
+            },
+            "schemes": [
+                "http"
+            ]
+        })
+
+    from .endpoints.endpoints import product_blueprint
+    app.register_blueprint(product_blueprint)
+
+    from .database.db import close_read_session
+    app.teardown_appcontext(close_read_session)
+
+    from .metrics.metrics import start_request_metrics, record_request_metrics, record_failed_request
+    app.before_request(start_request_metrics)
+    app.after_request(record_request_metrics)
+    app.teardown_request(record_failed_request)
+
+    # Después de start_request_metrics, para que las peticiones rechazadas también se midan
+    from .admission.admission import admit_request, shed_busy_request, release_request
+    app.before_request(admit_request)
+    app.after_request(shed_busy_request)
+    app.teardown_request(release_request)
+
+    from .commands import reconcile_aggregates_command, export_products_command, compact_changes_command, refresh_snapshot_command
+    app.cli.add_command(reconcile_aggregates_command)
+    app.cli.add_command(compact_changes_command)
+    app.cli.add_command(export_products_command)
+    app.cli.add_command(refresh_snapshot_command)
+
+    return app
@@ -0,0 +1,167 @@
+from ..cache.cache import redis_client, redis_call
+from ..metrics.metrics import ADMISSION_DECISIONS, DB_REQUESTS_IN_FLIGHT, current_route
+from collections import namedtuple
+from flask import g, has_request_context, make_response, request
+from os import environ
+import functools, json, math, threading
+
+# Control de admisión: las peticiones que sobran se rechazan enseguida (429/503 con Retry-After)
+# en vez de hacer cola en el pool de conexiones de Postgres.
+ADMISSION_ENABLED = environ.get('ADMISSION_ENABLED', '1').lower() in ('1', 'true', 'yes')
+
+# Límite de una ruta: ritmo (peticiones por segundo) y ráfaga, para la ruta entera y para cada cliente. 0 = sin límite
+RateLimit = namedtuple('RateLimit', ['rate', 'burst', 'client_rate', 'client_burst'])
+
+def parse_limit(value):
+    # "ritmo/ráfaga", por ejemplo "20/40"; "0" desactiva el límite
+    rate, _, burst = value.partition('/')
+    return float(rate), float(burst or rate)
+
+def rate_limit(name, limit, client_limit):
+    # Ajustable con <NOMBRE>_RATE_LIMIT y <NOMBRE>_CLIENT_RATE_LIMIT
+    prefix = name.upper()
+    rate, burst = parse_limit(environ.get(f'{prefix}_RATE_LIMIT', limit))
+    client_rate, client_burst = parse_limit(environ.get(f'{prefix}_CLIENT_RATE_LIMIT', client_limit))
+    return RateLimit(rate, burst, client_rate, client_burst)
+
+# Las rutas que leen todo el catálogo tienen límites propios; el resto comparte DEFAULT (sin límite salvo que se configure)
+DEFAULT_LIMIT = rate_limit('default', '0', '0')
+ROUTE_LIMITS = {
+    'products.get_all_products': rate_limit('getall', '20/40', '2/5'),
+    'products.export_all_products': rate_limit('export', '1/2', '0.2/1')
+}
+# Rutas que no pasan por el control de admisión: no tocan Postgres y deben responder aunque la API esté saturada
+EXEMPT_ENDPOINTS = {'products.get_metrics', 'products.get_cache_stats', 'products.get_pool_stats', 'products.get_admission_stats'}
+# Rutas que casi siempre responden desde la caché: la plaza de base de datos se toma solo cuando van a Postgres (uses_database)
+CACHED_ENDPOINTS = {
+    'products.get_all_products', 'products.get_products_byQuantity', 'products.search_products',
+    'products.query_products', 'products.get_product', 'products.get_many_products'
+}
+
+# Peticiones simultáneas que pueden usar la base de datos en cada worker; por defecto, las conexiones del pool
+DB_MAX_CONCURRENT_REQUESTS = int(environ.get('DB_MAX_CONCURRENT_REQUESTS', int(environ.get('DB_POOL_SIZE', 5)) + int(environ.get('DB_MAX_OVERFLOW', 10))))
+DB_BUSY_RETRY_AFTER = 1
+db_slots = threading.BoundedSemaphore(DB_MAX_CONCURRENT_REQUESTS) if DB_MAX_CONCURRENT_REQUESTS > 0 else None
+in_flight = 0
+
+# Las dos cubetas (ruta y cliente) se comprueban y se descuentan en una sola llamada atómica.
+# La hora es la de Redis: todas las instancias comparten las cubetas aunque sus relojes no coincidan.
+# Devuelve {0} si se admite, o {1 ruta / 2 cliente, milisegundos hasta que haya una ficha}.
+take_tokens_script = redis_client.register_script("""
+redis.replicate_commands()
+local time = redis.call('TIME')
+local now = tonumber(time[1]) + tonumber(time[2]) / 1000000
+local buckets = {}
+for i = 1, 2 do
+    local rate, burst = tonumber(ARGV[i * 2 - 1]), tonumber(ARGV[i * 2])
+    if rate > 0 then
+        local state = redis.call('HMGET', KEYS[i], 'tokens', 'ts')
+        local tokens = tonumber(state[1]) or burst
+        local elapsed = math.max(0, now - (tonumber(state[2]) or now))
+        tokens = math.min(burst, tokens + elapsed * rate)
+        if tokens < 1 then
+            return {i, math.ceil((1 - tokens) / rate * 1000)}
+        end
+        buckets[i] = {tokens - 1, math.ceil(burst / rate * 1000) + 1000}
+    end
+end
+for i, bucket in pairs(buckets) do
+    redis.call('HSET', KEYS[i], 'tokens', tostring(bucket[1]), 'ts', string.format('%.6f', now))
+    redis.call('PEXPIRE', KEYS[i], bucket[2])
+end
+return {0}
+""")
+
+def client_id():
+    # Sin proxy delante, la dirección de la conexión identifica al cliente
+    return request.remote_addr or 'unknown'
+
+def route_limit(endpoint):
+    return ROUTE_LIMITS.get(endpoint, DEFAULT_LIMIT)
+
+def shed(status, reason, retry_after):
+    ADMISSION_DECISIONS.labels(current_route(), reason).inc()
+    message = 'Too many requests, retry later' if status == 429 else 'Server busy, retry later'
+    return make_response(json.dumps({'Error': message, 'Reason': reason}), status, {
+        'Content-Type': 'application/json',
+        'Retry-After': str(max(1, math.ceil(retry_after)))
+    })
+
+def take_tokens(endpoint, limit):
+    # Devuelve None si se admite, o (motivo, segundos de espera). Si Redis no está disponible, se admite la petición
+    if limit.rate <= 0 and limit.client_rate <= 0:
+        return None
+    keys = [f'ratelimit:{endpoint}', f'ratelimit:{endpoint}:{client_id()}']
+    args = [limit.rate, limit.burst, limit.client_rate, limit.client_burst]
+    result = redis_call(lambda: take_tokens_script(keys=keys, args=args), 'ratelimit', default=None)
+    if result is None:
+        ADMISSION_DECISIONS.labels(current_route(), 'limiter_unavailable').inc()
+        return None
+    if result[0] == 0:
+        return None
+    return ('route_rate' if result[0] == 1 else 'client_rate'), result[1] / 1000
+
+class DatabaseBusy(Exception):
+    """Every database slot of the worker is busy."""
+
+def acquire_db_slot():
+    # Sin espera: si todas las plazas del worker están ocupadas, la petición se rechaza en vez de esperar una conexión.
+    # Devuelve False si no hay plaza; fuera de una petición admitida (hilos de refresco, comandos) no hace nada
+    global in_flight
+    if db_slots is None or not has_request_context() or not g.get('admitted') or g.get('db_slot'):
+        return True
+    if not db_slots.acquire(blocking=False):
+        return False
+    g.db_slot = True
+    in_flight += 1
+    DB_REQUESTS_IN_FLIGHT.inc()
+    return True
+
+def uses_database(function):
+    # Para el trabajo con Postgres de las rutas de CACHED_ENDPOINTS: toma la plaza al llamar a function.
+    # Si no hay, lanza DatabaseBusy; el endpoint la trata como cualquier error y shed_busy_request cambia su respuesta por un 503
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        if not acquire_db_slot():
+            g.db_busy = True
+            raise DatabaseBusy('Server busy, retry later')
+        return function(*args, **kwargs)
+    return wrapper
+
+def admit_request():
+    endpoint = request.endpoint
+    if not ADMISSION_ENABLED or endpoint is None or not endpoint.startswith('products.') or endpoint in EXEMPT_ENDPOINTS:
+        return None
+
+    limited = take_tokens(endpoint, route_limit(endpoint))
+    if limited:
+        return shed(429, *limited)
+
+    g.admitted = True
+    if endpoint not in CACHED_ENDPOINTS and not acquire_db_slot():
+        return shed(503, 'concurrency', DB_BUSY_RETRY_AFTER)
+    ADMISSION_DECISIONS.labels(current_route(), 'admitted').inc()
+    return None
+
+def shed_busy_request(response):
+    if g.pop('db_busy', False):
+        return shed(503, 'concurrency', DB_BUSY_RETRY_AFTER)
+    return response
+
+def release_request(exception=None):
+    # teardown: se ejecuta también si el endpoint lanzó una excepción
+    global in_flight
+    if g.pop('db_slot', False):
+        in_flight -= 1
+        DB_REQUESTS_IN_FLIGHT.dec()
+        db_slots.release()
+
+def admission_stats():
+    limits = {'default': DEFAULT_LIMIT._asdict()}
+    limits.update({endpoint: limit._asdict() for endpoint, limit in ROUTE_LIMITS.items()})
+    return {
+        'Enabled': ADMISSION_ENABLED,
+        'DbMaxConcurrentRequests': DB_MAX_CONCURRENT_REQUESTS,
+        'DbRequestsInFlight': in_flight,
+        'RateLimits': limits
+    }
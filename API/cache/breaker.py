@@ -0,0 +1,49 @@
+import threading, time
+
+class CircuitBreaker:
+    # Tras threshold fallos seguidos el circuito se abre y no se llama al servicio. Pasados reset_timeout
+    # segundos un solo llamador lo prueba (half_open): si funciona se cierra, si no vuelve a abrirse.
+    CLOSED, OPEN, HALF_OPEN = 'closed', 'open', 'half_open'
+
+    def __init__(self, threshold, reset_timeout, on_change=None):
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.on_change = on_change
+        self.lock = threading.Lock()
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+
+    def closed(self):
+        return self.state == self.CLOSED
+
+    def attempt(self):
+        # CLOSED: llamar; OPEN: saltarse el servicio; HALF_OPEN: este llamador hace la prueba
+        with self.lock:
+            if self.state == self.OPEN and time.monotonic() - self.opened_at >= self.reset_timeout:
+                self.set_state(self.HALF_OPEN)
+                return self.HALF_OPEN
+            return self.CLOSED if self.state == self.CLOSED else self.OPEN
+
+    def success(self):
+        with self.lock:
+            self.failures = 0
+            if self.state != self.CLOSED:
+                self.set_state(self.CLOSED)
+
+    def failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.state == self.HALF_OPEN or self.failures >= self.threshold:
+                self.opened_at = time.monotonic()
+                if self.state != self.OPEN:
+                    self.set_state(self.OPEN)
+
+    def set_state(self, state):
+        self.state = state
+        if self.on_change is not None:
+            self.on_change(state)
+
+    def stats(self):
+        with self.lock:
+            return {'State': self.state, 'ConsecutiveFailures': self.failures}
@@ -1,11 +1,511 @@
-import redis
+from .local import LocalCache
+from .breaker import CircuitBreaker
+from ..metrics.metrics import count_cache, key_family, CACHE_KEYS_DELETED, CACHE_INVALIDATION_TIME, CACHE_BREAKER_TRANSITIONS, CACHE_INVALIDATIONS_PENDING
+from collections import namedtuple
+from flask import current_app, g
+from os import environ, getpid
+import redis, hashlib, json, random, struct, threading, time, uuid
 
-redis_client = redis.StrictRedis(host = 'InventAPI_cache', port=6379, db=0)
+# La conexión se abre en el primer comando, no al importar. Pool explícito y timeouts cortos:
+# un Redis lento no puede sumar más de REDIS_SOCKET_TIMEOUT a cada llamada.
+REDIS_URL = environ.get('REDIS_URL', 'redis://InventAPI_cache:6379/0')
+REDIS_MAX_CONNECTIONS = int(environ.get('REDIS_MAX_CONNECTIONS', 50))
+REDIS_POOL_TIMEOUT = float(environ.get('REDIS_POOL_TIMEOUT', 0.1))
+REDIS_SOCKET_TIMEOUT = float(environ.get('REDIS_SOCKET_TIMEOUT', 0.1))
+REDIS_CONNECT_TIMEOUT = float(environ.get('REDIS_CONNECT_TIMEOUT', 0.1))
+redis_pool = redis.BlockingConnectionPool.from_url(
+    REDIS_URL,
+    max_connections=REDIS_MAX_CONNECTIONS,
+    timeout=REDIS_POOL_TIMEOUT,
+    socket_timeout=REDIS_SOCKET_TIMEOUT,
+    socket_connect_timeout=REDIS_CONNECT_TIMEOUT,
+    health_check_interval=30
+)
+redis_client = redis.StrictRedis(connection_pool=redis_pool)
+# La suscripción pasa largos ratos sin mensajes: conexión propia, sin timeout de lectura
+pubsub_client = redis.StrictRedis.from_url(REDIS_URL, socket_connect_timeout=REDIS_CONNECT_TIMEOUT, socket_keepalive=True)
 
-def clear_product_quantity_cache():
+# Circuito: tras REDIS_BREAKER_THRESHOLD fallos seguidos no se llama a Redis durante REDIS_BREAKER_RESET segundos
+# y las peticiones van directamente a Postgres
+REDIS_BREAKER_THRESHOLD = int(environ.get('REDIS_BREAKER_THRESHOLD', 3))
+REDIS_BREAKER_RESET = float(environ.get('REDIS_BREAKER_RESET', 5))
+breaker = CircuitBreaker(REDIS_BREAKER_THRESHOLD, REDIS_BREAKER_RESET, on_change=lambda state: CACHE_BREAKER_TRANSITIONS.labels(state).inc())
+
+# Invalidaciones que no llegaron a Redis; se reenvían en cuanto vuelve, antes de leer de nuevo de la caché.
+# Si hay más de INVALIDATION_QUEUE_MAX claves sueltas se guarda solo la marca de borrar todas las de producto.
+INVALIDATION_QUEUE_MAX = int(environ.get('INVALIDATION_QUEUE_MAX', 10000))
+pending_namespaces = set()
+pending_keys = set()
+pending_overflow = False
+pending_lock = threading.Lock()
+replay_lock = threading.Lock()
+replayer_pid = None
+# Otros módulos que también guardan escrituras para cuando Redis vuelva (las marcas de los SKUs aleatorios):
+# pares (hay algo pendiente, reenviarlo) que se ejecutan después de las invalidaciones
+replay_tasks = []
+
+# Valor devuelto por redis_call cuando no se pudo usar Redis
+SKIPPED = object()
+
+CACHE_TTL = 3600
+
+# Retraso máximo de la réplica (DB_READ_AFTER_WRITE_WINDOW). Lo que se lee de ella durante ese tiempo
+# después de una escritura de cualquier worker puede ser anterior a la escritura y no se guarda en caché.
+READ_AFTER_WRITE_WINDOW = float(environ.get('DB_READ_AFTER_WRITE_WINDOW', 5))
+LAST_WRITE_KEY = 'last_write_at'
+
+# Caché L1 opcional dentro de cada proceso (L1_CACHE_SIZE=0 la desactiva)
+L1_CACHE_SIZE = int(environ.get('L1_CACHE_SIZE', 0))
+L1_CACHE_TTL = float(environ.get('L1_CACHE_TTL', 5))
+INVALIDATION_CHANNEL = 'inventapi_invalidate'
+
+local_cache = LocalCache(L1_CACHE_SIZE, L1_CACHE_TTL) if L1_CACHE_SIZE > 0 else None
+listener_pid = None
+listener_lock = threading.Lock()
+
+def listen_invalidations():
+    # Mantiene la L1 coherente entre procesos e instancias. Si se pierde la conexión
+    # se vacía la L1, porque pudo perderse algún mensaje.
+    while True:
+        try:
+            pubsub = pubsub_client.pubsub(ignore_subscribe_messages=True)
+            pubsub.subscribe(INVALIDATION_CHANNEL)
+            local_cache.clear()
+            for message in pubsub.listen():
+                apply_invalidation(json.loads(message['data']))
+        except Exception as e:
+            print(f"Error listening for cache invalidations: {str(e)}")
+            local_cache.clear()
+            time.sleep(1)
+
+def ensure_listener():
+    # El hilo se arranca en el primer uso de cada proceso (también después de un fork)
+    global listener_pid
+    if listener_pid == getpid():
+        return
+    with listener_lock:
+        if listener_pid != getpid():
+            local_cache.clear()
+            threading.Thread(target=listen_invalidations, name='cache-invalidation', daemon=True).start()
+            listener_pid = getpid()
+
+def apply_invalidation(message):
+    if message.get('clear'):
+        local_cache.clear()
+    local_cache.delete(*[generation_key(namespace) for namespace in message.get('namespaces', [])])
+    local_cache.delete(*message.get('keys', []))
+
+def redis_failure(error):
+    print(f"Error calling Redis: {str(error)}")
+    breaker.failure()
+
+def redis_available():
+    # Con el circuito abierto no se llama a Redis. Pasados REDIS_BREAKER_RESET segundos una petición
+    # lo prueba con PING y reenvía las invalidaciones pendientes antes de volver a usar la caché.
+    state = breaker.attempt()
+    if state == CircuitBreaker.OPEN:
+        return False
+    if state == CircuitBreaker.CLOSED and not has_pending_replays():
+        return True
+    try:
+        if state == CircuitBreaker.HALF_OPEN:
+            redis_client.ping()
+            bump_all_generations()
+        replay_pending()
+    except redis.RedisError as e:
+        redis_failure(e)
+        return False
+    breaker.success()
+    return True
+
+def redis_call(operation, key, default=SKIPPED):
+    # operation() usa redis_client. Si el circuito está abierto o la llamada falla se devuelve default
+    # y la petición sigue sin caché; key solo sirve para contar la familia en las métricas.
+    if not redis_available():
+        count_cache('skip', key)
+        return default
+    try:
+        result = operation()
+    except redis.RedisError as e:
+        count_cache('error', key)
+        redis_failure(e)
+        return default
+    breaker.success()
+    return result
+
+def cache_get(key):
+    # Mientras Redis falla la L1 no recibe invalidaciones de otros procesos: tampoco se lee
+    if local_cache is not None and breaker.closed():
+        ensure_listener()
+        value = local_cache.get(key)
+        if value is not None:
+            count_cache('hit', key)
+            return value
+
+    value = redis_call(lambda: redis_client.get(key), key)
+    if value is SKIPPED:
+        return None
+    count_cache('miss' if value is None else 'hit', key)
+    if value is not None and local_cache is not None:
+        local_cache.set(key, value)
+    return value
+
+def cache_set(key, ttl, value):
+    if redis_call(lambda: redis_client.setex(key, ttl, value), key) is SKIPPED:
+        return
+    count_cache('set', key)
+    if local_cache is not None:
+        local_cache.set(key, value if isinstance(value, bytes) else str(value).encode(), ttl)
+
+# Política de caché de cada endpoint. Pasado soft_ttl la entrada sigue sirviéndose mientras un solo
+# worker la reconstruye en segundo plano; pasado hard_ttl Redis la borra. Sin entrada, un solo worker
+# reconstruye (lock_ttl) y el resto espera hasta lock_wait segundos antes de ir a la base de datos.
+CachePolicy = namedtuple('CachePolicy', ['soft_ttl', 'hard_ttl', 'lock_ttl', 'lock_wait'])
+
+def cache_policy(name, soft_ttl, hard_ttl=CACHE_TTL, lock_ttl=30, lock_wait=2):
+    prefix = name.upper()
+    return CachePolicy(
+        soft_ttl=int(environ.get(f'{prefix}_SOFT_TTL', soft_ttl)),
+        hard_ttl=int(environ.get(f'{prefix}_HARD_TTL', hard_ttl)),
+        lock_ttl=int(environ.get(f'{prefix}_LOCK_TTL', lock_ttl)),
+        lock_wait=float(environ.get(f'{prefix}_LOCK_WAIT', lock_wait))
+    )
+
+# Respuesta guardada: cuerpo, ETag (hash del cuerpo), Last-Modified, momento en que deja de estar fresca y momento en que se construyó
+CachedResponse = namedtuple('CachedResponse', ['body', 'etag', 'last_modified', 'fresh_until', 'built_at'])
+
+# Cabecera de cada entrada en Redis: marca, fresca hasta, última modificación, construcción y hash del cuerpo
+ENTRY_MAGIC = b'\x00G'
+ENTRY_HEADER = struct.Struct('>2sddd16s')
+
+release_lock_script = redis_client.register_script("""
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+""")
+
+def cached_response(result):
+    # result: bytes de la respuesta, o (bytes, última modificación en epoch)
+    if result is None:
+        return None
+    body, last_modified = result if isinstance(result, tuple) else (result, time.time())
+    return CachedResponse(body, hashlib.sha1(body).hexdigest()[:32], last_modified, 0.0, time.time())
+
+def pack_entry(response, policy):
+    return ENTRY_HEADER.pack(ENTRY_MAGIC, time.time() + policy.soft_ttl, response.last_modified, response.built_at, bytes.fromhex(response.etag)) + response.body
+
+def unpack_entry(entry):
+    if entry[:len(ENTRY_MAGIC)] == ENTRY_MAGIC:
+        _, fresh_until, last_modified, built_at, digest = ENTRY_HEADER.unpack_from(entry)
+        return CachedResponse(entry[ENTRY_HEADER.size:], digest.hex(), last_modified, fresh_until, built_at)
+    # Cabecera de otra versión: se ignora la entrada
+    if entry[:1] == b'\x00':
+        return None
+    # Entradas sin cabecera (guardadas por versiones anteriores): se tratan como caducadas
+    return cached_response(entry)
+
+def acquire_lock(key, policy):
+    token = uuid.uuid4().hex
+    if redis_call(lambda: redis_client.set(f"lock_{key}", token, nx=True, ex=policy.lock_ttl), key, default=None):
+        return token
+    return None
+
+def release_lock(key, token):
+    redis_call(lambda: release_lock_script(keys=[f"lock_{key}"], args=[token]), key)
+
+def replica_read_stale():
+    # g.read_from_replica lo pone read_session(); se consume aquí para que valga para una sola construcción
+    if not g.pop('read_from_replica', False):
+        return False
+    return redis_call(lambda: redis_client.exists(LAST_WRITE_KEY), LAST_WRITE_KEY, default=True) != 0
+
+def rebuild(key, build, policy, namespace=None):
+    response = cached_response(build())
+    if response is not None and namespace is not None:
+        # Listados: los validadores salen de la versión del catálogo, no del cuerpo ni de la hora de construcción
+        changed_at = namespace_changed_at(namespace)
+        response = response._replace(etag=version_etag(key), last_modified=changed_at if changed_at is not None else response.last_modified)
+    if response is not None and not replica_read_stale():
+        cache_set(key, policy.hard_ttl, pack_entry(response, policy))
+    return response
+
+def refresh_in_background(app, key, build, policy, token, namespace):
+    try:
+        with app.app_context():
+            rebuild(key, build, policy, namespace)
+    except Exception as e:
+        print(f"Error refreshing cache key {key}: {str(e)}")
+    finally:
+        release_lock(key, token)
+
+def cached_fetch(key, build, policy, namespace=None):
+    # build() devuelve los bytes de la respuesta (opcionalmente con su última modificación),
+    # o None si no hay nada que guardar. Devuelve un CachedResponse o None.
+    # Con namespace, key es una clave de namespace_key (None si Redis no está disponible).
+    if key is None:
+        return cached_response(build())
+    entry = cache_get(key)
+    response = unpack_entry(entry) if entry is not None else None
+    if response is not None:
+        if response.fresh_until < time.time():
+            token = acquire_lock(key, policy)
+            if token:
+                app = current_app._get_current_object()
+                threading.Thread(target=refresh_in_background, args=(app, key, build, policy, token, namespace), daemon=True).start()
+        return response
+
+    token = acquire_lock(key, policy)
+    if token:
+        try:
+            return rebuild(key, build, policy, namespace)
+        finally:
+            release_lock(key, token)
+
+    # Otro worker está reconstruyendo la entrada: se espera un momento antes de ir a la base de datos.
+    # Sin Redis no hay nada que esperar.
+    deadline = time.monotonic() + policy.lock_wait
+    while time.monotonic() < deadline and breaker.closed():
+        time.sleep(0.05)
+        entry = redis_call(lambda: redis_client.get(key), key, default=None)
+        response = unpack_entry(entry) if entry is not None else None
+        if response is not None:
+            return response
+    return cached_response(build())
+
+def cache_get_many(keys):
+    # Una sola llamada MGET para todo lo que no esté en la L1
+    use_local = local_cache is not None and breaker.closed()
+    values = [local_cache.get(key) if use_local else None for key in keys]
+    if use_local:
+        ensure_listener()
+    missing = [index for index, value in enumerate(values) if value is None]
+    if missing:
+        found = redis_call(lambda: redis_client.mget([keys[index] for index in missing]), keys[missing[0]])
+        if found is SKIPPED:
+            return values
+        for index, value in zip(missing, found):
+            values[index] = value
+            if value is not None and local_cache is not None:
+                local_cache.set(keys[index], value)
+    for key, value in zip(keys, values):
+        count_cache('miss' if value is None else 'hit', key)
+    return values
+
+def cache_set_many(results, policy):
+    # results: {clave: lo mismo que devuelve build()}; se guardan con un solo pipeline de SETEX
+    if not results:
+        return
+    pipe = redis_client.pipeline(transaction=False)
+    entries = {key: pack_entry(cached_response(result), policy) for key, result in results.items()}
+    for key, entry in entries.items():
+        pipe.setex(key, policy.hard_ttl, entry)
+    if redis_call(pipe.execute, next(iter(entries))) is SKIPPED:
+        return
+    for key, entry in entries.items():
+        count_cache('set', key)
+        if local_cache is not None:
+            local_cache.set(key, entry, policy.hard_ttl)
+
+def local_cache_stats():
+    return local_cache.stats() if local_cache is not None else None
+
+# Cada familia de claves lleva un número de generación. Invalidar una familia es un solo INCR:
+# las claves de generaciones anteriores dejan de leerse y expiran solas por TTL.
+CACHE_NAMESPACES = ('all_products', 'products_quantity', 'products_search', 'products_query', 'product_fields')
+
+def generation_key(namespace):
+    return f"gen_{namespace}"
+
+def changed_at_key(namespace):
+    return f"gen_{namespace}_at"
+
+# Una generación nueva empieza en un número al azar: si Redis pierde sus datos no se repiten generaciones
+# ya usadas, ni los ETag que salen de ellas. Cada cambio guarda también su hora (reloj de Redis) para Last-Modified.
+bump_generations_script = redis_client.register_script("""
+redis.replicate_commands()
+local now = redis.call('TIME')
+for i = 1, #KEYS, 2 do
+    if redis.call('EXISTS', KEYS[i]) == 0 then
+        redis.call('SET', KEYS[i], ARGV[(i + 1) / 2])
+    end
+    redis.call('INCR', KEYS[i])
+    redis.call('SET', KEYS[i + 1], now[1] .. '.' .. string.format('%06d', now[2]))
+end
+return #KEYS / 2
+""")
+
+def new_generation():
+    return random.randint(1, 2 ** 48)
+
+def bump_generations(namespaces, client):
+    keys = [key for namespace in namespaces for key in (generation_key(namespace), changed_at_key(namespace))]
+    return bump_generations_script(keys=keys, args=[new_generation() for _ in namespaces], client=client)
+
+def seed_generation(namespace):
+    key = generation_key(namespace)
+    redis_client.set(key, new_generation(), nx=True)
+    return redis_client.get(key)
+
+def namespace_key(namespace, *parts):
+    # None si Redis no está disponible: sin generación no hay clave válida y la respuesta se construye sin caché
+    generation = cache_get(generation_key(namespace))
+    if generation is None:
+        generation = redis_call(lambda: seed_generation(namespace), generation_key(namespace), default=None)
+        if generation is None:
+            return None
+    return ':'.join([namespace, str(int(generation))] + [str(part) for part in parts])
+
+def version_etag(key):
+    # ETag de una entrada con generación: sale de la clave (generación y parámetros), sin leer el cuerpo
+    return hashlib.sha1(key.encode()).hexdigest()[:32]
+
+def namespace_changed_at(namespace):
+    changed_at = redis_call(lambda: redis_client.get(changed_at_key(namespace)), changed_at_key(namespace), default=None)
+    return float(changed_at) if changed_at is not None else None
+
+def bump_all_generations():
+    # Tras un corte, las invalidaciones que quedaron en la memoria de otros workers (o de uno que ya terminó)
+    # no llegarán nunca: el primer proceso que ve volver a Redis cambia la generación de todas las familias.
+    # Las claves product_<SKU> no tienen generación y dependen de la cola de cada proceso.
+    pipe = redis_client.pipeline(transaction=False)
+    bump_generations(CACHE_NAMESPACES, pipe)
+    mark_last_write(pipe)
+    message = {'namespaces': list(CACHE_NAMESPACES), 'keys': []}
+    if local_cache is not None:
+        pipe.publish(INVALIDATION_CHANNEL, json.dumps(message))
+    pipe.execute()
+    if local_cache is not None:
+        apply_invalidation(message)
+    for namespace in CACHE_NAMESPACES:
+        count_cache('invalidate', namespace)
+
+def mark_last_write(pipe):
+    # Va en la misma ida y vuelta que el cambio de generación: ninguna reconstrucción ve la generación nueva sin la marca
+    pipe.set(LAST_WRITE_KEY, repr(time.time()), px=int(READ_AFTER_WRITE_WINDOW * 1000) + 1)
+
+def invalidate(*namespaces, keys=()):
+    started = time.perf_counter()
     try:
-        for key in redis_client.scan_iter("products_quantity_*"):
-            redis_client.delete(key)
+        pipe = redis_client.pipeline(transaction=False)
+        if namespaces:
+            bump_generations(namespaces, pipe)
+        # DEL uno por uno para saber cuántas claves de cada familia se borraron realmente
+        for key in keys:
+            pipe.delete(key)
+        mark_last_write(pipe)
+        message = {'namespaces': list(namespaces), 'keys': list(keys)}
+        if local_cache is not None:
+            pipe.publish(INVALIDATION_CHANNEL, json.dumps(message))
+        results = redis_call(pipe.execute, generation_key(namespaces[0]) if namespaces else (list(keys) or ['keys'])[0])
+        if local_cache is not None:
+            apply_invalidation(message)
+
+        # Redis no está disponible: la invalidación se guarda para reenviarla cuando vuelva
+        if results is SKIPPED:
+            queue_invalidation(namespaces, keys)
+            return
+        for namespace in namespaces:
+            count_cache('invalidate', namespace)
+        for key, deleted in zip(keys, results[int(bool(namespaces)):]):
+            count_cache('invalidate', key)
+            CACHE_KEYS_DELETED.labels(key_family(key)).inc(deleted)
     except Exception as e:
-        print(f"Error clearing product quantity cache: {str(e)}")
+        print(f"Error invalidating cache: {str(e)}")
+    finally:
+        CACHE_INVALIDATION_TIME.labels(','.join(namespaces) or 'keys').observe(time.perf_counter() - started)
+
+def has_pending_invalidations():
+    return bool(pending_namespaces or pending_keys or pending_overflow)
+
+def has_pending_replays():
+    return has_pending_invalidations() or any(pending() for pending, _ in replay_tasks)
+
+def replay_pending():
+    replay_invalidations()
+    for pending, replay in replay_tasks:
+        if pending():
+            replay()
+
+def pending_invalidations():
+    return len(pending_namespaces) + len(pending_keys) + int(pending_overflow)
+
+def queue_invalidation(namespaces, keys):
+    global pending_overflow
+    with pending_lock:
+        pending_namespaces.update(namespaces)
+        if pending_overflow or len(pending_keys) + len(keys) > INVALIDATION_QUEUE_MAX:
+            pending_overflow = True
+            pending_keys.clear()
+        else:
+            pending_keys.update(keys)
+        CACHE_INVALIDATIONS_PENDING.set(pending_invalidations())
+    ensure_replayer()
 
+def replay_invalidations():
+    # Lanza RedisError si Redis sigue fallando; lo que no se llegó a reenviar sigue en la cola
+    global pending_overflow
+    if not has_pending_invalidations() or not replay_lock.acquire(blocking=False):
+        return
+    try:
+        with pending_lock:
+            namespaces, keys, overflow = set(pending_namespaces), set(pending_keys), pending_overflow
+        pipe = redis_client.pipeline(transaction=False)
+        if namespaces:
+            bump_generations(namespaces, pipe)
+        for key in keys:
+            pipe.delete(key)
+        mark_last_write(pipe)
+        pipe.execute()
+        if overflow:
+            # Se perdió la lista de claves: se borran todas las entradas de producto sueltas
+            batch = []
+            for key in redis_client.scan_iter(match='product_*', count=1000):
+                batch.append(key)
+                if len(batch) == 1000:
+                    redis_client.delete(*batch)
+                    batch = []
+            if batch:
+                redis_client.delete(*batch)
+        if local_cache is not None:
+            redis_client.publish(INVALIDATION_CHANNEL, json.dumps({'namespaces': list(namespaces), 'keys': list(keys), 'clear': overflow}))
+
+        with pending_lock:
+            pending_namespaces.difference_update(namespaces)
+            pending_keys.difference_update(keys)
+            if overflow:
+                pending_overflow = False
+            CACHE_INVALIDATIONS_PENDING.set(pending_invalidations())
+        print(f"Replayed {len(namespaces)} namespace and {len(keys)} key invalidations")
+    finally:
+        replay_lock.release()
+
+def replay_pending_invalidations():
+    # Aunque este proceso no reciba peticiones, la cola se reenvía en cuanto Redis vuelve
+    global replayer_pid
+    while True:
+        time.sleep(REDIS_BREAKER_RESET)
+        redis_available()
+        with pending_lock:
+            if not has_pending_replays():
+                replayer_pid = None
+                return
+
+def ensure_replayer():
+    global replayer_pid
+    with pending_lock:
+        if replayer_pid == getpid():
+            return
+        replayer_pid = getpid()
+    threading.Thread(target=replay_pending_invalidations, name='cache-invalidation-replay', daemon=True).start()
+
+def cache_stats():
+    return dict(breaker.stats(), PendingInvalidations=pending_invalidations())
+
+def invalidate_products(*skus):
+    # Una sola ida y vuelta a Redis por escritura
+    # Las proyecciones (?fields=) de un producto van en su propia familia para no borrar una clave por cada combinación de campos
+    invalidate(*CACHE_NAMESPACES, keys=[f"product_{sku}" for sku in skus])
+
+def clear_product_quantity_cache():
+    invalidate('products_quantity')
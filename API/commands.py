@@ -0,0 +1,53 @@
+from flask.cli import with_appcontext
+from .database.db import reconcile_aggregates, compact_changes, CHANGES_TOMBSTONE_DAYS
+from .database.export import export_products, available_formats, EXPORT_BATCH_SIZE
+from .database.snapshot import snapshot_enabled, refresh_snapshot
+import click, json, sys
+
+@click.command('reconcile-aggregates')
+@click.option('--fix', is_flag=True, help='Rewrite the aggregates from a full scan when drift is found.')
+@with_appcontext
+def reconcile_aggregates_command(fix):
+    """Check the inventory aggregates against a full scan of products."""
+    drift = reconcile_aggregates(fix=fix)
+    for row in drift:
+        click.echo(json.dumps(row))
+    if not drift:
+        click.echo('Aggregates are up to date')
+    elif fix:
+        click.echo(f'Fixed {len(drift)} aggregates')
+    else:
+        raise SystemExit(1)
+
+@click.command('compact-changes')
+@click.option('--tombstone-days', type=int, default=CHANGES_TOMBSTONE_DAYS, show_default=True, help='Days deletes are kept in the change log.')
+@with_appcontext
+def compact_changes_command(tombstone_days):
+    """Compact the product change log: keep the last change of each SKU and purge old deletes."""
+    click.echo(json.dumps(compact_changes(tombstone_days)))
+
+@click.command('export-products')
+@click.option('--format', 'export_format', type=click.Choice(['csv', 'parquet']), default='csv', show_default=True)
+@click.option('--output', '-o', default='-', help='File to write, or - for standard output.')
+@click.option('--batch-size', type=int, default=EXPORT_BATCH_SIZE, show_default=True, help='Rows read from the database per batch.')
+@with_appcontext
+def export_products_command(export_format, output, batch_size):
+    """Export the whole catalog to CSV or Parquet without going through the cache."""
+    if export_format not in available_formats():
+        raise click.UsageError('Parquet export needs pyarrow: pip install pyarrow')
+    stream = sys.stdout.buffer if output == '-' else open(output, 'wb')
+    try:
+        for chunk in export_products(export_format, batch_size):
+            stream.write(chunk)
+    finally:
+        if stream is not sys.stdout.buffer:
+            stream.close()
+
+@click.command('refresh-snapshot')
+@click.option('--full', is_flag=True, help='Rebuild from a full scan instead of applying the change log.')
+@with_appcontext
+def refresh_snapshot_command(full):
+    """Bring the columnar snapshot up to date with the change log."""
+    if not snapshot_enabled():
+        raise click.UsageError('The snapshot engine needs SNAPSHOT_DIR and numpy: pip install numpy')
+    click.echo(json.dumps(refresh_snapshot(full=full)))
@@ -1,8 +1,28 @@
 from API import db
-import random, string
+from API.cache.cache import redis_client, redis_call, ensure_replayer, replay_tasks, SKIPPED, READ_AFTER_WRITE_WINDOW
+from sqlalchemy.dialects.postgresql import TSVECTOR, insert
+from flask import current_app, g, has_request_context, request
+from sqlalchemy.orm import Session
+from .pool import TimedQueuePool
+from os import environ
+import random, string, threading, time
+
+# Configuración de texto de la búsqueda; 'simple' no depende del idioma de los productos
+SEARCH_CONFIG = 'simple'
+
+# Productos con esta cantidad o menos cuentan como poco stock en los agregados
+LOW_STOCK_THRESHOLD = int(environ.get('LOW_STOCK_THRESHOLD', 10))
 
 class Product(db.Model):
     __tablename__ = 'products'
+    __table_args__ = (
+        db.Index('ix_products_quantity_sku', 'Quantity', 'SKU'),
+        # Índices de /products/query: filtro por igualdad, orden por rango y SKU para la paginación
+        db.Index('ix_products_department_quantity', 'Department', 'Quantity', 'SKU'),
+        db.Index('ix_products_brand_price', 'Brand', 'Price', 'SKU'),
+        db.Index('ix_products_price_sku', 'Price', 'SKU'),
+        db.Index('ix_products_search', 'search_vector', postgresql_using='gin'),
+    )
 
     SKU = db.Column(db.String(9), primary_key=True, unique=True, nullable=False)
     Product = db.Column(db.String(80), nullable=False)
@@ -11,9 +31,19 @@ class Product(db.Model):
     Department = db.Column(db.String(90), nullable=False)
     Quantity = db.Column(db.Integer, nullable=False)
     Price = db.Column(db.Float, nullable=False)
+    # Última modificación de la fila, usada para Last-Modified
+    UpdatedAt = db.Column(db.DateTime(timezone=True), nullable=False, server_default=db.func.now(), onupdate=db.func.now())
+    # Columna generada por Postgres para la búsqueda de texto; no se carga salvo que se pida
+    search_vector = db.deferred(db.Column(TSVECTOR, db.Computed(
+        f"setweight(to_tsvector('{SEARCH_CONFIG}', \"Product\"), 'A') || "
+        f"setweight(to_tsvector('{SEARCH_CONFIG}', \"Brand\"), 'B') || "
+        f"setweight(to_tsvector('{SEARCH_CONFIG}', \"Department\"), 'B') || "
+        f"setweight(to_tsvector('{SEARCH_CONFIG}', \"Description\"), 'C')",
+        persisted=True
+    )))
 
-    def __init__(self, Product, Description, Quantity, Brand, Department, Price):
-        self.SKU = generate_sku(Department, Product, Brand)
+    def __init__(self, Product, Description, Quantity, Brand, Department, Price, SKU=None):
+        self.SKU = SKU or generate_sku(Department, Product, Brand)
         self.Product = Product
         self.Description = Description
         self.Brand = Brand
@@ -21,19 +51,416 @@ class Product(db.Model):
         self.Quantity = Quantity
         self.Price = Price
 
-def generate_sku(department, product, brand):
-    first_letter = department[0].upper()
-    second_letter = product[0].upper()
-    third_letter = brand[0].upper()
+class InventoryAggregate(db.Model):
+    # Resumen por departamento y por marca, actualizado con deltas en cada escritura
+    __tablename__ = 'inventory_aggregates'
+
+    Dimension = db.Column(db.String(20), primary_key=True)
+    Name = db.Column(db.String(90), primary_key=True)
+    SKUs = db.Column(db.Integer, nullable=False, default=0)
+    StockValue = db.Column(db.Float, nullable=False, default=0)
+    LowStock = db.Column(db.Integer, nullable=False, default=0)
+
+class ProductChange(db.Model):
+    # Registro de cambios para /products/changes, escrito en la misma transacción que cada escritura.
+    # TxId es la transacción que escribió la fila: el feed se ordena por (TxId, Id) y solo entrega
+    # transacciones que ya terminaron, así que una posición entregada nunca queda por delante de un cambio pendiente.
+    __tablename__ = 'product_changes'
+    __table_args__ = (
+        db.Index('ix_product_changes_position', 'TxId', 'Id'),
+        db.Index('ix_product_changes_sku', 'SKU'),
+    )
+
+    Id = db.Column(db.BigInteger, primary_key=True)
+    TxId = db.Column(db.BigInteger, nullable=False, server_default=db.text('txid_current()'))
+    SKU = db.Column(db.String(9), nullable=False)
+    Operation = db.Column(db.String(6), nullable=False)
+    ChangedAt = db.Column(db.DateTime(timezone=True), nullable=False, server_default=db.func.now())
+
+class ProductChangeHorizon(db.Model):
+    # Posición más alta de las bajas purgadas por la compactación; los tokens anteriores ya no son válidos
+    __tablename__ = 'product_changes_horizon'
+
+    Id = db.Column(db.Integer, primary_key=True)
+    TxId = db.Column(db.BigInteger, nullable=False)
+    ChangeId = db.Column(db.BigInteger, nullable=False)
+
+# Cada prefijo (departamento, producto, marca) admite SKUs del 000001 al 999999
+SKU_CAPACITY = 999999
+# Rondas de reserva antes de pasar a SKUs aleatorios
+SKU_RESERVE_ATTEMPTS = 5
+# Al crear un contador que no existía (o que se perdió), números por encima del SKU más alto guardado que también se comprueban:
+# cubren los SKUs que otras peticiones reservaron con el contador perdido y todavía no han guardado
+SKU_RESEED_MARGIN = int(environ.get('SKU_RESEED_MARGIN', 100000))
+
+# Reserva rangos de SKUs de varios prefijos en una sola llamada. KEYS: contador y marca de cada prefijo.
+# La marca es el número más alto que puede estar ocupado sin haber salido del contador (SKUs antiguos o aleatorios):
+# solo los números reservados hasta la marca se comprueban contra products.
+# ARGV, por prefijo: cantidad, SKU más alto guardado (-1 si no se ha consultado) y número aleatorio más alto usado sin Redis
+# (0 si ninguno); al final, SKU_RESEED_MARGIN.
+# Devuelve por prefijo {último número reservado, marca}, o false si su contador no existe y falta el SKU más alto.
+reserve_sku_script = redis_client.register_script("""
+local margin = tonumber(ARGV[#ARGV])
+local result = {}
+for i = 1, #KEYS / 2 do
+    local counter, mark = KEYS[i * 2 - 1], KEYS[i * 2]
+    local count, last, fallback = tonumber(ARGV[i * 3 - 2]), tonumber(ARGV[i * 3 - 1]), tonumber(ARGV[i * 3])
+    local stored = tonumber(redis.call('GET', mark)) or 0
+    local checked = math.max(stored, fallback)
+    if last >= 0 and redis.call('EXISTS', counter) == 0 then
+        -- El contador empieza en cero y reutiliza los huecos; todo lo que pueda estar ocupado queda por debajo de la marca
+        if last > 0 then
+            checked = math.max(checked, last + margin)
+        end
+        redis.call('SET', counter, 0)
+    end
+    if checked > stored then
+        redis.call('SET', mark, checked)
+    end
+    if count == 0 then
+        result[i] = {0, checked}
+    elseif redis.call('EXISTS', counter) == 0 then
+        result[i] = false
+    else
+        result[i] = {redis.call('INCRBY', counter, count), checked}
+    end
+end
+return result
+""")
+
+# Número aleatorio más alto de cada prefijo usado por este proceso sin Redis, pendiente de subir su marca
+pending_sku_marks = {}
+pending_sku_lock = threading.Lock()
+
+def sku_prefix(department, product, brand):
+    return f"{department[0].upper()}{product[0].upper()}{brand[0].upper()}"
+
+def sku_counter_key(prefix):
+    return f"sku_seq_{prefix}"
+
+def sku_legacy_key(prefix):
+    return f"sku_legacy_{prefix}"
+
+def last_sku_numbers(prefixes):
+    # Número del SKU más alto de cada prefijo, con una sola consulta (una búsqueda en el índice por prefijo)
+    columns = [
+        db.session.query(db.func.max(Product.SKU)).filter(Product.SKU.between(f"{prefix}000000", f"{prefix}{SKU_CAPACITY}")).scalar_subquery()
+        for prefix in prefixes
+    ]
+    return [int(sku[3:]) if sku else 0 for sku in db.session.query(*columns).one()]
 
-    while True:
-        random_digits = ''.join(random.choices(string.digits, k=6))
+def reserve_sku_ranges(counts, last_saved):
+    # Una llamada al script; las marcas pendientes viajan en ella con cantidad cero. Lanza RedisError si Redis falla
+    with pending_sku_lock:
+        marks = dict(pending_sku_marks)
+    prefixes = list(counts) + [prefix for prefix in marks if prefix not in counts]
+    if not prefixes:
+        return {}
+    keys = [key for prefix in prefixes for key in (sku_counter_key(prefix), sku_legacy_key(prefix))]
+    args = [value for prefix in prefixes for value in (counts.get(prefix, 0), last_saved.get(prefix, -1), marks.get(prefix, 0))]
+    results = reserve_sku_script(keys=keys, args=args + [SKU_RESEED_MARGIN])
+    with pending_sku_lock:
+        for prefix, number in marks.items():
+            if pending_sku_marks.get(prefix) == number:
+                del pending_sku_marks[prefix]
+    return {prefix: (int(result[0]), int(result[1])) if result else None for prefix, result in zip(counts, results)}
 
-        sku = f"{first_letter}{second_letter}{third_letter}{random_digits}"
+def replay_sku_marks():
+    reserve_sku_ranges({}, {})
 
-        if not Product.query.filter_by(SKU=sku).first():
+replay_tasks.append((lambda: bool(pending_sku_marks), replay_sku_marks))
+
+def remember_random_skus(skus):
+    # Los SKUs aleatorios no salen del contador: la marca de su prefijo tiene que quedar por encima
+    with pending_sku_lock:
+        for sku in skus:
+            pending_sku_marks[sku[:3]] = max(pending_sku_marks.get(sku[:3], 0), int(sku[3:]))
+    if redis_call(replay_sku_marks, 'sku') is SKIPPED:
+        ensure_replayer()
+
+def reserve_skus(counts):
+    # counts: {prefijo: cantidad}. Cada ronda es una llamada a Redis para todos los prefijos; solo los números que no
+    # superan la marca de su prefijo se comprueban, con una única consulta. Puede devolver menos SKUs de los pedidos
+    # (Redis no disponible, prefijo lleno o demasiadas rondas): el resto se elige al azar
+    skus = {prefix: [] for prefix in counts}
+    last_saved, full = {}, set()
+    for _ in range(SKU_RESERVE_ATTEMPTS):
+        needed = {prefix: count - len(skus[prefix]) for prefix, count in counts.items() if len(skus[prefix]) < count and prefix not in full}
+        if not needed:
             break
+        reserved = redis_call(lambda: reserve_sku_ranges(needed, last_saved), 'sku')
+        if reserved is SKIPPED:
+            break
+
+        # Contadores que no existen: se crean en la siguiente ronda con el SKU más alto de cada prefijo
+        missing = [prefix for prefix, result in reserved.items() if result is None]
+        if missing:
+            last_saved.update(zip(missing, last_sku_numbers(missing)))
+
+        candidates = []
+        for prefix, result in reserved.items():
+            if result is None:
+                continue
+            last, mark = result
+            for number in range(last - needed[prefix] + 1, min(last, SKU_CAPACITY) + 1):
+                if number <= mark:
+                    candidates.append(f"{prefix}{number:06d}")
+                else:
+                    skus[prefix].append(f"{prefix}{number:06d}")
+            if last >= SKU_CAPACITY:
+                full.add(prefix)
+
+        used = {row.SKU for row in Product.query.with_entities(Product.SKU).filter(Product.SKU.in_(candidates)).all()} if candidates else set()
+        for sku in candidates:
+            if sku not in used:
+                skus[sku[:3]].append(sku)
+
+    return skus
+
+def generate_sku(department, product, brand):
+    return generate_skus([(department, product, brand)])[0]
+
+def generate_skus(items):
+    prefixes = [sku_prefix(department, product, brand) for department, product, brand in items]
+    positions = {}
+    for index, prefix in enumerate(prefixes):
+        positions.setdefault(prefix, []).append(index)
+
+    # Un contador atómico por prefijo en Redis, todos los prefijos del lote en la misma llamada.
+    # Pasada la marca de un prefijo no hay consultas extra ni colisiones entre peticiones concurrentes
+    skus = [None] * len(prefixes)
+    for prefix, reserved in reserve_skus({prefix: len(indexes) for prefix, indexes in positions.items()}).items():
+        for index, sku in zip(positions[prefix], reserved):
+            skus[index] = sku
+
+    # Prefijos llenos o Redis no disponible: se buscan SKUs libres al azar
+    pending = [index for index in range(len(prefixes)) if skus[index] is None]
+    if pending:
+        random_skus = probe_skus([prefixes[index] for index in pending])
+        for index, sku in zip(pending, random_skus):
+            skus[index] = sku
+        remember_random_skus(random_skus)
+
+    return skus
+
+def probe_skus(prefixes):
+    # Genera SKUs al azar con una sola consulta de colisiones por ronda
+    skus = [None] * len(prefixes)
+    pending = list(range(len(prefixes)))
+    taken = set()
+
+    while pending:
+        candidates = {}
+        for index in pending:
+            sku = f"{prefixes[index]}{''.join(random.choices(string.digits, k=6))}"
+            if sku not in taken and sku not in candidates:
+                candidates[sku] = index
+
+        existing = {row.SKU for row in Product.query.with_entities(Product.SKU).filter(Product.SKU.in_(list(candidates))).all()} if candidates else set()
+
+        for sku, index in candidates.items():
+            if sku not in existing:
+                skus[index] = sku
+                taken.add(sku)
+
+        pending = [index for index in pending if skus[index] is None]
+
+    return skus
+
+def sku_prefix_usage():
+    # Cuántos SKUs hay por prefijo y qué tan lleno está cada uno
+    prefix = db.func.substr(Product.SKU, 1, 3)
+    counts = db.session.query(prefix, db.func.count()).group_by(prefix).order_by(prefix).all()
+    # Sin Redis se devuelven los conteos sin la parte reservada
+    reserved = redis_call(lambda: redis_client.mget([sku_counter_key(name) for name, _ in counts]), 'sku', default=None) if counts else []
+    reserved = reserved or [None] * len(counts)
+
+    return [
+        {
+            'Prefix': name,
+            'Products': total,
+            'Reserved': min(int(last), SKU_CAPACITY) if last else None,
+            'Capacity': SKU_CAPACITY,
+            'Usage': round(total / SKU_CAPACITY, 6)
+        }
+        for (name, total), last in zip(counts, reserved)
+    ]
+
+AGGREGATE_DIMENSIONS = ('Department', 'Brand')
+
+def product_state(product):
+    # Los campos de un producto que afectan a los agregados
+    if isinstance(product, dict):
+        return {field: product[field] for field in AGGREGATE_DIMENSIONS + ('Quantity', 'Price')}
+    return {field: getattr(product, field) for field in AGGREGATE_DIMENSIONS + ('Quantity', 'Price')}
+
+def apply_aggregate_deltas(before=(), after=()):
+    # Suma los estados nuevos y resta los anteriores; se ejecuta dentro de la misma transacción que la escritura
+    deltas = {}
+    for states, sign in ((before, -1), (after, 1)):
+        for state in states:
+            for dimension in AGGREGATE_DIMENSIONS:
+                delta = deltas.setdefault((dimension, state[dimension]), [0, 0.0, 0])
+                delta[0] += sign
+                delta[1] += sign * state['Quantity'] * state['Price']
+                delta[2] += sign * (state['Quantity'] <= LOW_STOCK_THRESHOLD)
+
+    rows = [
+        {'Dimension': dimension, 'Name': name, 'SKUs': skus, 'StockValue': value, 'LowStock': low}
+        for (dimension, name), (skus, value, low) in sorted(deltas.items())
+        if skus or value or low
+    ]
+    if not rows:
+        return
+
+    table = InventoryAggregate.__table__
+    statement = insert(table).values(rows)
+    statement = statement.on_conflict_do_update(
+        index_elements=[table.c.Dimension, table.c.Name],
+        set_={
+            'SKUs': table.c.SKUs + statement.excluded.SKUs,
+            'StockValue': table.c.StockValue + statement.excluded.StockValue,
+            'LowStock': table.c.LowStock + statement.excluded.LowStock
+        }
+    )
+    db.session.execute(statement)
+
+def compute_aggregates():
+    # Recalcula los agregados desde cero con un recorrido completo de products
+    totals = {}
+    for dimension in AGGREGATE_DIMENSIONS:
+        column = getattr(Product, dimension)
+        rows = db.session.query(
+            column,
+            db.func.count(),
+            db.func.coalesce(db.func.sum(Product.Quantity * Product.Price), 0),
+            db.func.count().filter(Product.Quantity <= LOW_STOCK_THRESHOLD)
+        ).group_by(column).all()
+        for name, skus, value, low in rows:
+            totals[(dimension, name)] = (skus, float(value), low)
+    return totals
+
+def reconcile_aggregates(fix=False, tolerance=0.01):
+    # Compara los agregados guardados con un recálculo completo; con fix=True reescribe la tabla.
+    # El bloqueo hace que las escrituras en curso apliquen su delta antes o después del recálculo, nunca a medias.
+    if fix:
+        db.session.execute(db.text('LOCK TABLE inventory_aggregates IN EXCLUSIVE MODE'))
+    expected = compute_aggregates()
+    stored = {(row.Dimension, row.Name): (row.SKUs, row.StockValue, row.LowStock) for row in InventoryAggregate.query.all()}
+
+    drift = []
+    for key in sorted(set(expected) | set(stored)):
+        want = expected.get(key, (0, 0.0, 0))
+        have = stored.get(key, (0, 0.0, 0))
+        if want[0] != have[0] or want[2] != have[2] or abs(want[1] - have[1]) > tolerance:
+            drift.append({
+                'Dimension': key[0],
+                'Name': key[1],
+                'Expected': {'SKUs': want[0], 'StockValue': want[1], 'LowStock': want[2]},
+                'Stored': {'SKUs': have[0], 'StockValue': have[1], 'LowStock': have[2]}
+            })
+
+    if fix and drift:
+        InventoryAggregate.query.delete()
+        db.session.bulk_insert_mappings(InventoryAggregate, [
+            {'Dimension': dimension, 'Name': name, 'SKUs': skus, 'StockValue': value, 'LowStock': low}
+            for (dimension, name), (skus, value, low) in expected.items()
+        ])
+    if fix:
+        db.session.commit()
+    return drift
+
+CHANGE_UPSERT = 'upsert'
+CHANGE_DELETE = 'delete'
+# Días que se conservan las bajas en el registro de cambios antes de purgarlas
+CHANGES_TOMBSTONE_DAYS = int(environ.get('CHANGES_TOMBSTONE_DAYS', 30))
+
+def record_changes(operation, skus):
+    # Se ejecuta dentro de la transacción de la escritura, antes del commit
+    if skus:
+        db.session.execute(ProductChange.__table__.insert(), [{'SKU': sku, 'Operation': operation} for sku in skus])
+
+def change_feed_head():
+    # Toda transacción con id menor que el xmin del snapshot ya terminó: sus cambios ya no pueden aparecer
+    return db.session.execute(db.text('SELECT txid_snapshot_xmin(txid_current_snapshot())')).scalar()
+
+def change_feed_horizon():
+    horizon = db.session.get(ProductChangeHorizon, 1)
+    return (horizon.TxId, horizon.ChangeId) if horizon else None
+
+def read_changes(after, limit):
+    # Cambios posteriores a la posición after = (TxId, Id), con el estado actual del producto para las altas y cambios
+    table = ProductChange.__table__
+    columns = [getattr(Product, name) for name in ('SKU', 'Product', 'Description', 'Brand', 'Department', 'Quantity', 'Price')]
+    query = db.session.query(table.c.TxId, table.c.Id, table.c.SKU.label('ChangedSKU'), table.c.Operation, *columns) \
+        .select_from(table) \
+        .outerjoin(Product, Product.SKU == table.c.SKU) \
+        .filter(db.tuple_(table.c.TxId, table.c.Id) > db.tuple_(*after)) \
+        .filter(table.c.TxId < change_feed_head()) \
+        .order_by(table.c.TxId.asc(), table.c.Id.asc()) \
+        .limit(limit)
+    return query.all()
+
+def compact_changes(tombstone_days=CHANGES_TOMBSTONE_DAYS):
+    # 1. De cada SKU solo importa su último cambio: el feed siempre devuelve el estado actual del producto
+    superseded = db.session.execute(db.text("""
+        DELETE FROM product_changes AS old USING product_changes AS newer
+        WHERE newer."SKU" = old."SKU" AND (newer."TxId", newer."Id") > (old."TxId", old."Id")
+    """)).rowcount
+
+    # 2. Las bajas se conservan tombstone_days días; los tokens anteriores a la última purgada caducan
+    purged = db.session.execute(db.text("""
+        DELETE FROM product_changes
+        WHERE "Operation" = :operation AND "ChangedAt" < now() - make_interval(days => :days)
+          AND "TxId" < txid_snapshot_xmin(txid_current_snapshot())
+        RETURNING "TxId", "Id"
+    """), {'operation': CHANGE_DELETE, 'days': tombstone_days}).fetchall()
+    if purged:
+        tx_id, change_id = max(tuple(row) for row in purged)
+        table = ProductChangeHorizon.__table__
+        statement = insert(table).values(Id=1, TxId=tx_id, ChangeId=change_id)
+        db.session.execute(statement.on_conflict_do_update(
+            index_elements=[table.c.Id],
+            set_={'TxId': statement.excluded.TxId, 'ChangeId': statement.excluded.ChangeId},
+            where=db.tuple_(table.c.TxId, table.c.ChangeId) < db.tuple_(statement.excluded.TxId, statement.excluded.ChangeId)
+        ))
+    db.session.commit()
+    return {'Superseded': superseded, 'TombstonesPurged': len(purged)}
+
+# Lecturas en la réplica (DB_READ_URL). Tras una escritura, durante DB_READ_AFTER_WRITE_WINDOW segundos
+# las lecturas del cliente que escribió (cookie) siguen yendo a la base principal.
+READ_PRIMARY_COOKIE = 'read_primary_until'
+
+def has_read_replica():
+    return 'read' in (current_app.config.get('SQLALCHEMY_BINDS') or {})
+
+def mark_write():
+    return time.time() + READ_AFTER_WRITE_WINDOW
+
+def read_after_write():
+    if has_request_context():
+        try:
+            return float(request.cookies.get(READ_PRIMARY_COOKIE, 0)) > time.time()
+        except ValueError:
+            return False
+    return False
+
+def read_session():
+    if not has_read_replica() or read_after_write():
+        return db.session
+    if 'read_session' not in g:
+        g.read_session = Session(bind=db.get_engine(current_app, 'read'))
+    # Para no guardar en caché lo leído de la réplica justo después de una escritura (replica_read_stale)
+    g.read_from_replica = True
+    return g.read_session
 
-    return sku
+def close_read_session(exception=None):
+    session = g.pop('read_session', None)
+    if session is not None:
+        session.close()
 
-db.create_all()
+def pool_stats():
+    engines = {'primary': db.engine}
+    if has_read_replica():
+        engines['read'] = db.get_engine(current_app, 'read')
+    return {name: engine.pool.stats() for name, engine in engines.items() if isinstance(engine.pool, TimedQueuePool)}
@@ -0,0 +1,93 @@
+from .db import Product, read_session
+from sqlalchemy import select
+from importlib.util import find_spec
+from os import environ
+import csv, io
+
+EXPORT_BATCH_SIZE = int(environ.get('EXPORT_BATCH_SIZE', 10000))
+EXPORT_COLUMNS = ('SKU', 'Product', 'Description', 'Brand', 'Department', 'Quantity', 'Price')
+EXPORT_FORMATS = {
+    'csv': {'mimetype': 'text/csv', 'extension': 'csv'},
+    'parquet': {'mimetype': 'application/vnd.apache.parquet', 'extension': 'parquet'}
+}
+
+def available_formats():
+    # pyarrow es opcional (sin él solo se exporta CSV) y pesado: se importa solo al exportar Parquet
+    return [name for name in EXPORT_FORMATS if name != 'parquet' or find_spec('pyarrow') is not None]
+
+def product_batches(batch_size=EXPORT_BATCH_SIZE):
+    # Cursor del lado del servidor: Postgres envía las filas por bloques y solo hay un bloque en memoria.
+    # Se leen columnas sueltas, sin crear objetos Product, y sin pasar por la caché.
+    columns = [getattr(Product, name) for name in EXPORT_COLUMNS]
+    statement = select(*columns).order_by(Product.SKU.asc()).execution_options(stream_results=True, max_row_buffer=batch_size)
+    result = read_session().execute(statement)
+    try:
+        for rows in result.partitions(batch_size):
+            yield rows
+    finally:
+        result.close()
+
+def export_csv(batch_size=EXPORT_BATCH_SIZE):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(EXPORT_COLUMNS)
+    for rows in product_batches(batch_size):
+        writer.writerows(rows)
+        yield buffer.getvalue().encode()
+        buffer.seek(0)
+        buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue().encode()
+
+class ChunkSink(io.RawIOBase):
+    """Write-only stream that keeps what pyarrow writes until it is drained."""
+
+    def __init__(self):
+        self.chunks = []
+        self.position = 0
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        self.position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.position
+
+    def drain(self):
+        data = b''.join(self.chunks)
+        self.chunks = []
+        return data
+
+def export_parquet(batch_size=EXPORT_BATCH_SIZE):
+    # Cada bloque se escribe como un row group y se envía en cuanto pyarrow lo termina
+    import pyarrow, pyarrow.parquet
+    schema = pyarrow.schema([
+        ('SKU', pyarrow.string()),
+        ('Product', pyarrow.string()),
+        ('Description', pyarrow.string()),
+        ('Brand', pyarrow.string()),
+        ('Department', pyarrow.string()),
+        ('Quantity', pyarrow.int32()),
+        ('Price', pyarrow.float64())
+    ])
+    sink = ChunkSink()
+    writer = pyarrow.parquet.ParquetWriter(sink, schema)
+    try:
+        for rows in product_batches(batch_size):
+            columns = list(zip(*rows))
+            writer.write_table(pyarrow.Table.from_arrays([pyarrow.array(column, type=field.type) for column, field in zip(columns, schema)], schema=schema))
+            data = sink.drain()
+            if data:
+                yield data
+    finally:
+        writer.close()
+    yield sink.drain()
+
+def export_products(export_format, batch_size=EXPORT_BATCH_SIZE):
+    if export_format == 'parquet':
+        return export_parquet(batch_size)
+    return export_csv(batch_size)
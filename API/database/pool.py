@@ -0,0 +1,46 @@
+from sqlalchemy.exc import TimeoutError
+from sqlalchemy.pool import QueuePool
+import threading, time
+
+class TimedQueuePool(QueuePool):
+    # QueuePool que mide cuánto espera cada checkout por una conexión libre
+    def __init__(self, creator, pool_size=5, max_overflow=10, **kw):
+        super().__init__(creator, pool_size=pool_size, max_overflow=max_overflow, **kw)
+        self.capacity = pool_size + max(max_overflow, 0)
+        self.stats_lock = threading.Lock()
+        self.checkouts = 0
+        self.timeouts = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+
+    def _do_get(self):
+        start = time.perf_counter()
+        timed_out = False
+        try:
+            return super()._do_get()
+        except TimeoutError:
+            timed_out = True
+            raise
+        finally:
+            waited = time.perf_counter() - start
+            with self.stats_lock:
+                self.checkouts += 1
+                self.timeouts += timed_out
+                self.wait_total += waited
+                self.wait_max = max(self.wait_max, waited)
+
+    def stats(self):
+        with self.stats_lock:
+            checked_out = self.checkedout()
+            return {
+                'Size': self.size(),
+                'CheckedOut': checked_out,
+                'Overflow': max(self.overflow(), 0),
+                'Capacity': self.capacity,
+                'Saturation': round(checked_out / self.capacity, 4) if self.capacity else None,
+                'Checkouts': self.checkouts,
+                'Timeouts': self.timeouts,
+                'WaitTotalSeconds': round(self.wait_total, 6),
+                'WaitAvgMs': round(self.wait_total / self.checkouts * 1000, 3) if self.checkouts else 0.0,
+                'WaitMaxMs': round(self.wait_max * 1000, 3)
+            }
@@ -0,0 +1,230 @@
+from API import db
+from .db import Product, ProductChange, read_changes, change_feed_head, change_feed_horizon, AGGREGATE_DIMENSIONS
+from sqlalchemy import select
+from importlib.util import find_spec
+from os import environ, path
+import json, os, shutil, tempfile, threading, time
+
+# Motor de lectura opcional: copia columnar de unas pocas columnas de products en arrays de NumPy.
+# Cada versión se guarda en SNAPSHOT_DIR y los workers la mapean en memoria, así que la comparten.
+SNAPSHOT_DIR = environ.get('SNAPSHOT_DIR')
+# Segundos tras los que una lectura pone la copia al día con el registro de cambios
+SNAPSHOT_MAX_AGE = float(environ.get('SNAPSHOT_MAX_AGE', 5))
+SNAPSHOT_CHANGES_BATCH = 10000
+SNAPSHOT_COLUMNS = ('SKU', 'Quantity', 'Price') + AGGREGATE_DIMENSIONS
+SNAPSHOT_POINTER = 'snapshot.json'
+
+# Versión mapeada por este proceso
+loaded = None
+refresh_lock = threading.Lock()
+
+def snapshot_enabled():
+    # NumPy es opcional y pesado: solo se importa cuando se usa la copia
+    return bool(SNAPSHOT_DIR) and find_spec('numpy') is not None
+
+class CatalogSnapshot:
+    """One version of the snapshot: columns sorted by SKU, Department and Brand as codes into a dictionary."""
+
+    def __init__(self, meta, columns, dictionaries):
+        self.meta = meta
+        self.columns = columns
+        self.dictionaries = dictionaries
+        self.codes = {name: {value: code for code, value in enumerate(values)} for name, values in dictionaries.items()}
+
+    def matching(self, min_quantity=0, max_quantity=None, department=None, brand=None):
+        # Posiciones (en orden de SKU) que cumplen los filtros, con comparaciones vectorizadas
+        import numpy
+        quantity = self.columns['Quantity']
+        mask = quantity >= min_quantity
+        if max_quantity is not None:
+            mask &= quantity <= max_quantity
+        for name, value in (('Department', department), ('Brand', brand)):
+            if value is None:
+                continue
+            code = self.codes[name].get(value)
+            if code is None:
+                return numpy.empty(0, dtype=numpy.intp)
+            mask &= self.columns[name] == code
+        return numpy.flatnonzero(mask)
+
+    def after(self, positions, sku):
+        # Paginación por SKU: las posiciones están ordenadas igual que la columna SKU
+        import numpy
+        return positions[numpy.searchsorted(positions, numpy.searchsorted(self.columns['SKU'], sku, side='right')):]
+
+    def rows(self, positions):
+        values = {name: self.columns[name][positions].tolist() for name in SNAPSHOT_COLUMNS}
+        for name in AGGREGATE_DIMENSIONS:
+            values[name] = [self.dictionaries[name][code] for code in values[name]]
+        return [dict(zip(SNAPSHOT_COLUMNS, row)) for row in zip(*(values[name] for name in SNAPSHOT_COLUMNS))]
+
+    def aggregates(self, dimension, low_stock_threshold):
+        # Lo mismo que inventory_aggregates, calculado con bincount sobre los códigos del diccionario
+        import numpy
+        codes, size = self.columns[dimension], len(self.dictionaries[dimension])
+        quantity, price = self.columns['Quantity'], self.columns['Price']
+        skus = numpy.bincount(codes, minlength=size)
+        stock_value = numpy.bincount(codes, weights=quantity * price, minlength=size)
+        low_stock = numpy.bincount(codes, weights=quantity <= low_stock_threshold, minlength=size)
+        return [
+            {'Name': name, 'SKUs': int(skus[code]), 'StockValue': round(float(stock_value[code]), 2), 'LowStock': int(low_stock[code])}
+            for name, code in sorted(self.codes[dimension].items()) if skus[code]
+        ]
+
+def version_dir(version):
+    return path.join(SNAPSHOT_DIR, f'v{version}')
+
+def read_pointer():
+    try:
+        with open(path.join(SNAPSHOT_DIR, SNAPSHOT_POINTER)) as pointer:
+            return json.load(pointer)
+    except FileNotFoundError:
+        return None
+
+def write_pointer(meta):
+    # Se reemplaza de forma atómica: un worker nunca lee un puntero a medio escribir
+    handle, temporary = tempfile.mkstemp(dir=SNAPSHOT_DIR, suffix='.tmp')
+    with os.fdopen(handle, 'w') as pointer:
+        json.dump(meta, pointer)
+    os.replace(temporary, path.join(SNAPSHOT_DIR, SNAPSHOT_POINTER))
+
+def load_version(meta):
+    import numpy
+    directory = version_dir(meta['Version'])
+    columns = {name: numpy.load(path.join(directory, f'{name}.npy'), mmap_mode='r') for name in SNAPSHOT_COLUMNS}
+    with open(path.join(directory, 'dictionaries.json')) as dictionaries:
+        return CatalogSnapshot(meta, columns, json.load(dictionaries))
+
+def write_version(version, columns, dictionaries):
+    import numpy
+    directory = version_dir(version)
+    temporary = directory + '.tmp'
+    shutil.rmtree(temporary, ignore_errors=True)
+    os.makedirs(temporary)
+    for name in SNAPSHOT_COLUMNS:
+        numpy.save(path.join(temporary, f'{name}.npy'), columns[name])
+    with open(path.join(temporary, 'dictionaries.json'), 'w') as output:
+        json.dump(dictionaries, output)
+    os.replace(temporary, directory)
+
+def remove_old_versions(version):
+    # Se conserva la versión anterior; los workers que aún la tienen mapeada siguen leyéndola aunque se borre
+    for name in os.listdir(SNAPSHOT_DIR):
+        if name.startswith('v') and name[1:].isdigit() and int(name[1:]) < version - 1:
+            shutil.rmtree(path.join(SNAPSHOT_DIR, name), ignore_errors=True)
+
+def merge_columns(base, upserts, deletes):
+    # upserts: {SKU: (Quantity, Price, Department, Brand)} con el estado actual; deletes: SKUs borrados.
+    # Los códigos existentes no cambian; los nombres nuevos se añaden al final del diccionario.
+    import numpy
+    sku_type = f'U{Product.SKU.type.length}'
+    dictionaries = {name: list(base.dictionaries[name]) if base else [] for name in AGGREGATE_DIMENSIONS}
+    codes = {name: {value: code for code, value in enumerate(values)} for name, values in dictionaries.items()}
+
+    def encode(name, value):
+        if value not in codes[name]:
+            codes[name][value] = len(dictionaries[name])
+            dictionaries[name].append(value)
+        return codes[name][value]
+
+    skus = sorted(upserts)
+    changed = {
+        'SKU': numpy.array(skus, dtype=sku_type),
+        'Quantity': numpy.array([upserts[sku][0] for sku in skus], dtype=numpy.int32),
+        'Price': numpy.array([upserts[sku][1] for sku in skus], dtype=numpy.float64),
+        'Department': numpy.array([encode('Department', upserts[sku][2]) for sku in skus], dtype=numpy.int32),
+        'Brand': numpy.array([encode('Brand', upserts[sku][3]) for sku in skus], dtype=numpy.int32)
+    }
+    if base is None:
+        return changed, dictionaries
+
+    keep = ~numpy.isin(base.columns['SKU'], numpy.array(sorted(set(upserts) | deletes), dtype=sku_type))
+    columns = {name: numpy.concatenate([base.columns[name][keep], changed[name]]) for name in SNAPSHOT_COLUMNS}
+    order = numpy.argsort(columns['SKU'], kind='stable')
+    return {name: column[order] for name, column in columns.items()}, dictionaries
+
+def pending_changes(after):
+    # Cambios posteriores a la posición after = (TxId, Id) que read_changes ya puede devolver (los de transacciones terminadas)
+    table = ProductChange.__table__
+    return db.session.query(db.func.count()).select_from(table) \
+        .filter(db.tuple_(table.c.TxId, table.c.Id) > db.tuple_(*after)) \
+        .filter(table.c.TxId < change_feed_head()) \
+        .scalar()
+
+def build_full():
+    # La posición se toma antes de leer: los cambios posteriores se vuelven a aplicar y aplicarlos es idempotente
+    position = [change_feed_head(), 0]
+    statement = select(*[getattr(Product, name) for name in SNAPSHOT_COLUMNS])
+    upserts = {row.SKU: (row.Quantity, row.Price, row.Department, row.Brand) for row in db.session.execute(statement)}
+    return merge_columns(None, upserts, set()), position, 0
+
+def build_incremental(meta):
+    # Se aplica el estado actual de cada SKU que cambió: si el producto ya no existe, es una baja
+    upserts, deletes = {}, set()
+    after = tuple(meta['Position'])
+    while True:
+        rows = read_changes(after, SNAPSHOT_CHANGES_BATCH)
+        for row in rows:
+            if row.SKU is None:
+                upserts.pop(row.ChangedSKU, None)
+                deletes.add(row.ChangedSKU)
+            else:
+                deletes.discard(row.ChangedSKU)
+                upserts[row.ChangedSKU] = (row.Quantity, row.Price, row.Department, row.Brand)
+        if rows:
+            after = (rows[-1].TxId, rows[-1].Id)
+        if len(rows) < SNAPSHOT_CHANGES_BATCH:
+            break
+    if not upserts and not deletes:
+        return (None, None), list(after), 0
+    return merge_columns(load_version(meta), upserts, deletes), list(after), len(upserts) + len(deletes)
+
+def refresh_snapshot(full=False, max_age=None, wait=True):
+    # Un solo proceso a la vez pone la copia al día (lock de fichero); con wait=False, si otro ya lo hace, devuelve None.
+    # Con max_age, no hace nada si otro proceso la refrescó mientras tanto.
+    import fcntl
+    if not refresh_lock.acquire(blocking=wait):
+        return None
+    try:
+        os.makedirs(SNAPSHOT_DIR, exist_ok=True)
+        with open(path.join(SNAPSHOT_DIR, '.lock'), 'w') as lock:
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX if wait else fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return None
+            meta = read_pointer()
+            if meta and not full and max_age is not None and time.time() - meta['CheckedAt'] <= max_age:
+                return meta
+
+            # Sin copia previa, o con bajas ya purgadas del registro de cambios después de su posición: se reconstruye
+            horizon = change_feed_horizon()
+            rebuild = full or meta is None or (horizon is not None and tuple(meta['Position']) < horizon)
+            (columns, dictionaries), position, changes = build_full() if rebuild else build_incremental(meta)
+            now = time.time()
+            if columns is None:
+                meta = dict(meta, Position=position, CheckedAt=now)
+            else:
+                version = meta['Version'] + 1 if meta else 1
+                write_version(version, columns, dictionaries)
+                meta = {'Version': version, 'Position': position, 'Rows': len(columns['SKU']), 'BuiltAt': now, 'CheckedAt': now}
+            write_pointer(meta)
+            remove_old_versions(meta['Version'])
+            db.session.commit()
+            return dict(meta, Changes=changes, Rebuilt=rebuild)
+    finally:
+        refresh_lock.release()
+
+def current_snapshot():
+    # El puntero se lee en cada petición; los ficheros solo se vuelven a mapear cuando cambia la versión.
+    # Si la copia es más antigua que SNAPSHOT_MAX_AGE, esta petición la pone al día, salvo que otro proceso ya lo esté haciendo.
+    global loaded
+    meta = read_pointer()
+    if meta is None:
+        meta = refresh_snapshot()
+    elif time.time() - meta['CheckedAt'] > SNAPSHOT_MAX_AGE:
+        meta = refresh_snapshot(max_age=SNAPSHOT_MAX_AGE, wait=False) or meta
+    snapshot = loaded
+    if snapshot is None or snapshot.meta['Version'] != meta['Version']:
+        snapshot = loaded = load_version(meta)
+    snapshot.meta = meta
+    return snapshot
@@ -0,0 +1,40 @@
+from flasgger import Swagger
+from os import environ
+import hashlib, json, os, tempfile
+
+# Directorio donde se guarda la especificación ya generada (vacío para no usar disco)
+SWAGGER_CACHE_DIR = environ.get('SWAGGER_CACHE_DIR', tempfile.gettempdir())
+
+class CachedSwagger(Swagger):
+    """Swagger whose spec is parsed from the docstrings once and then read from disk.
+
+    The file name carries a hash of the routes and their docstrings, so a new
+    deploy never serves the spec of the previous one.
+    """
+
+    def get_apispecs(self, endpoint='apispec_1'):
+        if self.app.debug or not SWAGGER_CACHE_DIR or endpoint in self.apispecs:
+            return super().get_apispecs(endpoint)
+
+        spec_path = os.path.join(SWAGGER_CACHE_DIR, f"inventapi-{endpoint}-{self.signature()}.json")
+        try:
+            with open(spec_path) as f:
+                self.apispecs[endpoint] = json.load(f)
+        except (OSError, ValueError):
+            spec = super().get_apispecs(endpoint)
+            try:
+                # Escritura atómica: otros workers pueden estar leyendo el mismo archivo
+                fd, temp_path = tempfile.mkstemp(dir=SWAGGER_CACHE_DIR)
+                with os.fdopen(fd, 'w') as f:
+                    json.dump(spec, f)
+                os.replace(temp_path, spec_path)
+            except OSError as e:
+                print(f"Error saving the API spec: {str(e)}")
+        return self.apispecs[endpoint]
+
+    def signature(self):
+        digest = hashlib.sha1(json.dumps(self.template, sort_keys=True, default=str).encode())
+        for rule in sorted(self.app.url_map.iter_rules(), key=lambda rule: rule.rule + rule.endpoint):
+            view = self.app.view_functions.get(rule.endpoint)
+            digest.update(f"{rule.rule} {sorted(rule.methods)} {getattr(view, '__doc__', None) or ''}".encode())
+        return digest.hexdigest()[:16]
@@ -1,15 +1,262 @@
-from flask import Blueprint, make_response, request, jsonify
+from flask import Blueprint, Response, make_response, request, jsonify, stream_with_context
 from API import db
-from ..database.db import Product
+from ..database.db import Product, InventoryAggregate, read_session, mark_write, has_read_replica, pool_stats, READ_PRIMARY_COOKIE, READ_AFTER_WRITE_WINDOW, generate_skus, sku_prefix_usage, product_state, apply_aggregate_deltas, record_changes, read_changes, change_feed_head, change_feed_horizon, CHANGE_UPSERT, CHANGE_DELETE, AGGREGATE_DIMENSIONS, LOW_STOCK_THRESHOLD, SEARCH_CONFIG
 from API.cache import cache
-from ..cache.cache import redis_client, clear_product_quantity_cache
-import json, re
+from ..database.export import export_products, available_formats, EXPORT_FORMATS
+from ..database.snapshot import snapshot_enabled, current_snapshot, pending_changes
+from .responses import dumps, loads, pack, json_response, conditional_response, version_not_modified, product_json, PRODUCT_FIELDS
+from ..metrics.metrics import render_metrics
+from ..admission.admission import admission_stats, uses_database
+from ..cache.cache import cached_fetch, cached_response, cache_get_many, cache_set_many, replica_read_stale, unpack_entry, cache_policy, local_cache_stats, cache_stats, namespace_key, version_etag, invalidate_products
+from psycopg2.errors import DeadlockDetected, SerializationFailure
+from sqlalchemy.exc import OperationalError
+from os import environ
+from datetime import datetime, timezone
+import json, re, base64, time, hashlib, math, operator, random
 
 product_blueprint = Blueprint('products', __name__)
+
+@product_blueprint.after_request
+def remember_write(response):
+    # Lectura después de escritura: el cliente que acaba de escribir lee de la base principal un momento
+    if request.method != 'GET' and request.endpoint != 'products.get_many_products' and response.status_code < 400:
+        primary_until = mark_write()
+        if has_read_replica():
+            response.set_cookie(READ_PRIMARY_COOKIE, str(primary_until), max_age=int(READ_AFTER_WRITE_WINDOW) + 1, httponly=True)
+    return response
  
  # Regex para permitir solo letras, números y espacios
 regex = r'^[a-zA-Z0-9\s]+$'
 
+required_fields = ['Product', 'Description', 'Quantity', 'Brand', 'Department', 'Price']
+
+# Límite de productos por petición en /products/bulk
+BULK_MAX_PRODUCTS = int(environ.get('BULK_MAX_PRODUCTS', 50000))
+BULK_INSERT_CHUNK = 1000
+
+# Tamaño máximo de página en /products/search
+SEARCH_MAX_PER_PAGE = 100
+
+# Filtros permitidos en /products/query: parámetro -> (columna, operador, tipo)
+QUERY_FILTERS = {
+    'department': ('Department', operator.eq, str),
+    'brand': ('Brand', operator.eq, str),
+    'min_price': ('Price', operator.ge, float),
+    'max_price': ('Price', operator.le, float),
+    'min_quantity': ('Quantity', operator.ge, int),
+    'max_quantity': ('Quantity', operator.le, int)
+}
+# Cada orden tiene un índice que termina en SKU (ix_products_price_sku, ix_products_quantity_sku y la clave primaria)
+QUERY_SORTS = ('SKU', 'Quantity', 'Price')
+QUERY_PARAMS = set(QUERY_FILTERS) | {'sort', 'order', 'per_page', 'cursor', 'fields'}
+QUERY_MAX_PER_PAGE = 100
+
+# Límite de ajustes de stock por petición en /products/adjust
+ADJUST_MAX_ITEMS = int(environ.get('ADJUST_MAX_ITEMS', 1000))
+# Intentos de un ajuste que Postgres aborta por interbloqueo o conflicto de serialización
+ADJUST_ATTEMPTS = 3
+# Rango de la columna Quantity (integer)
+QUANTITY_MAX = 2 ** 31 - 1
+
+# Tamaño máximo de página en /products/changes
+CHANGES_MAX_LIMIT = 1000
+
+# Tamaño máximo de página en /products/snapshot/getbyquantity/
+SNAPSHOT_MAX_PER_PAGE = 1000
+SNAPSHOT_DISABLED = 'The snapshot engine is disabled: set SNAPSHOT_DIR and install numpy'
+
+# Límite de SKUs por petición en /products/getmany
+GETMANY_MAX_SKUS = int(environ.get('GETMANY_MAX_SKUS', 500))
+
+# Guardar el catálogo completo en Redis es opcional: con catálogos grandes ocupa mucha memoria
+CACHE_ALL_PRODUCTS = environ.get('CACHE_ALL_PRODUCTS', '1').lower() in ('1', 'true', 'yes')
+STREAM_BATCH_SIZE = int(environ.get('STREAM_BATCH_SIZE', 1000))
+
+# Políticas de caché por endpoint, ajustables con <NOMBRE>_SOFT_TTL, _HARD_TTL, _LOCK_TTL y _LOCK_WAIT
+ALL_PRODUCTS_CACHE = cache_policy('all_products', soft_ttl=300)
+PRODUCTS_QUANTITY_CACHE = cache_policy('products_quantity', soft_ttl=300)
+PRODUCT_CACHE = cache_policy('product', soft_ttl=600)
+PRODUCTS_SEARCH_CACHE = cache_policy('products_search', soft_ttl=300)
+PRODUCTS_QUERY_CACHE = cache_policy('products_query', soft_ttl=300)
+
+def validate_product(data):
+    if not isinstance(data, dict) or not data:
+        return "Request body cannot be empty"
+    for field in required_fields:
+        if field not in data:
+            return f"Missing field: {field}"
+
+    if not isinstance(data['Product'], str) or not re.match(regex, data['Product']):
+        return "Product name can only contain letters, numbers, and spaces"
+    if not isinstance(data['Description'], str):
+        return "Description must be a string"
+    if not isinstance(data['Quantity'], int) or data['Quantity'] < 0:
+        return "Quantity must be a non-negative integer"
+    if not isinstance(data['Brand'], str) or not re.match(regex, data['Brand']):
+        return "Brand can only contain letters, numbers, and spaces"
+    if not isinstance(data['Department'], str) or not re.match(regex, data['Department']):
+        return "Department can only contain letters, numbers, and spaces"
+    if not isinstance(data['Price'], (int, float)) or data['Price'] < 0:
+        return 'Price must be a non-negative number'
+    return None
+
+def requested_fields():
+    # ?fields=Quantity,Price -> ('SKU', 'Quantity', 'Price'), en el orden de PRODUCT_FIELDS para que
+    # cada combinación tenga una sola clave de caché. Devuelve (campos, error).
+    value = request.args.get('fields')
+    if not value:
+        return PRODUCT_FIELDS, None
+    names = {field.lower(): field for field in PRODUCT_FIELDS}
+    requested = [name.strip() for name in value.split(',') if name.strip()]
+    unknown = [name for name in requested if name.lower() not in names]
+    if unknown:
+        return None, f"Unknown fields: {', '.join(unknown)}. Valid fields: {', '.join(PRODUCT_FIELDS)}"
+    selected = {names[name.lower()] for name in requested} | {'SKU'}
+    return tuple(field for field in PRODUCT_FIELDS if field in selected), None
+
+def product_columns(fields):
+    # Solo se leen de Postgres las columnas pedidas
+    return [getattr(Product, field) for field in fields]
+
+def projection_key(fields):
+    # Partes extra de la clave de caché; la respuesta completa conserva su clave de siempre
+    return () if fields == PRODUCT_FIELDS else ('.'.join(fields),)
+
+def listing_response(namespace, key, build, policy):
+    # El ETag de un listado sale de su clave (generación del espacio de nombres y parámetros):
+    # un sondeo sin cambios se responde sin leer la entrada de Redis
+    not_modified = version_not_modified(version_etag(key) if key is not None else None)
+    if not_modified is not None:
+        return not_modified
+    return conditional_response(cached_fetch(key, build, policy, namespace))
+
+@uses_database
+def stream_products(fields=PRODUCT_FIELDS):
+    # Cursor del lado del servidor: solo hay STREAM_BATCH_SIZE filas en memoria a la vez
+    products = read_session().query(*product_columns(fields)).order_by(Product.SKU.asc()).yield_per(STREAM_BATCH_SIZE)
+    lines = []
+    for product in products:
+        lines.append(dumps(product_json(product, fields)))
+        if len(lines) == STREAM_BATCH_SIZE:
+            yield b'\n'.join(lines) + b'\n'
+            lines = []
+    if lines:
+        yield b'\n'.join(lines) + b'\n'
+
+def valid_delta(value):
+    return isinstance(value, int) and not isinstance(value, bool) and -QUANTITY_MAX <= value <= QUANTITY_MAX
+
+def update_stock(deltas):
+    # Con varias filas se bloquean primero en orden de SKU: dos lotes que comparten productos esperan uno al otro
+    # en vez de interbloquearse. Una sola fila no necesita orden y basta con el UPDATE.
+    # La suma se hace en bigint para comprobar el rango de Quantity sin que Postgres dé un error de desbordamiento.
+    table = Product.__table__
+    if len(deltas) > 1:
+        Product.query.with_entities(Product.SKU).filter(Product.SKU.in_(list(deltas))).order_by(Product.SKU).with_for_update().all()
+    changes = db.values(db.column('SKU', db.String), db.column('Delta', db.Integer), name='changes').data(list(deltas.items()))
+    quantity = db.cast(table.c.Quantity, db.BigInteger) + changes.c.Delta
+    statement = table.update() \
+        .where(table.c.SKU == changes.c.SKU) \
+        .where(quantity.between(0, QUANTITY_MAX)) \
+        .values(Quantity=quantity) \
+        .returning(table.c.SKU, table.c.Product, table.c.Description, table.c.Brand, table.c.Department, table.c.Quantity, table.c.Price)
+    updated = {row.SKU: row for row in db.session.execute(statement)}
+
+    if updated:
+        after = [product_state(row) for row in updated.values()]
+        before = [dict(state, Quantity=state['Quantity'] - deltas[sku]) for sku, state in zip(updated, after)]
+        apply_aggregate_deltas(before=before, after=after)
+        record_changes(CHANGE_UPSERT, list(updated))
+    db.session.commit()
+    return updated
+
+def adjust_stock(deltas):
+    # Una sola sentencia UPDATE ... RETURNING: la suma es atómica y nunca deja cantidades negativas ni fuera de rango
+    for attempt in range(ADJUST_ATTEMPTS):
+        try:
+            updated = update_stock(deltas)
+            break
+        except OperationalError as e:
+            db.session.rollback()
+            if not isinstance(e.orig, (DeadlockDetected, SerializationFailure)) or attempt == ADJUST_ATTEMPTS - 1:
+                raise
+            time.sleep(random.uniform(0, 0.05 * (attempt + 1)))
+    if updated:
+        invalidate_products(*updated)
+
+    # Solo si algo falló: distinguir SKUs inexistentes, stock insuficiente y cantidades fuera de rango
+    failed = [sku for sku in deltas if sku not in updated]
+    existing = dict(Product.query.with_entities(Product.SKU, Product.Quantity).filter(Product.SKU.in_(failed)).all()) if failed else {}
+    failures = {
+        sku: 'Product not found' if sku not in existing else 'Insufficient stock' if existing[sku] + deltas[sku] < 0 else 'Quantity out of range'
+        for sku in failed
+    }
+    return updated, failures
+
+def parse_product_query():
+    # Valida los parámetros de /products/query contra QUERY_FILTERS y QUERY_SORTS. Devuelve (consulta, error);
+    # la consulta normalizada tiene una sola forma para cada combinación, de modo que sirve de firma de caché.
+    unknown = sorted(name for name in request.args if name not in QUERY_PARAMS)
+    if unknown:
+        return None, f"Unknown parameters: {', '.join(unknown)}. Valid parameters: {', '.join(sorted(QUERY_PARAMS))}"
+    repeated = sorted(name for name in request.args if len(request.args.getlist(name)) > 1)
+    if repeated:
+        return None, f"Parameters can only be given once: {', '.join(repeated)}"
+
+    filters = {}
+    for name, (field, _, kind) in QUERY_FILTERS.items():
+        value = request.args.get(name, '').strip()
+        if not value:
+            continue
+        if kind is str:
+            if len(value) > getattr(Product, field).type.length:
+                return None, f"{name} is too long"
+            filters[name] = value
+            continue
+        try:
+            number = kind(value)
+        except ValueError:
+            return None, f"{name} must be {'an integer' if kind is int else 'a number'}"
+        if not math.isfinite(number) or number < 0:
+            return None, f"{name} must be a non-negative number"
+        filters[name] = number
+    for low, high in (('min_price', 'max_price'), ('min_quantity', 'max_quantity')):
+        if low in filters and high in filters and filters[low] > filters[high]:
+            return None, f"{low} cannot be greater than {high}"
+
+    sorts = {name.lower(): name for name in QUERY_SORTS}
+    sort = sorts.get(request.args.get('sort', 'SKU').strip().lower())
+    if not sort:
+        return None, f"sort must be one of {', '.join(QUERY_SORTS)}"
+    order = request.args.get('order', 'asc').strip().lower()
+    if order not in ('asc', 'desc'):
+        return None, 'order must be asc or desc'
+    try:
+        per_page = int(request.args.get('per_page', 10))
+    except ValueError:
+        per_page = 0
+    if per_page <= 0 or per_page > QUERY_MAX_PER_PAGE:
+        return None, f'per_page must be between 1 and {QUERY_MAX_PER_PAGE}'
+    return {'Filters': dict(sorted(filters.items())), 'Sort': sort, 'Order': order, 'PerPage': per_page}, None
+
+def snapshot_info(snapshot):
+    # AgeSeconds: tiempo desde la última vez que la copia se puso al día con el registro de cambios
+    return {'Version': snapshot.meta['Version'], 'Rows': snapshot.meta['Rows'], 'AgeSeconds': round(time.time() - snapshot.meta['CheckedAt'], 3)}
+
+def encode_cursor(position, *filters):
+    # Cursor opaco: posición del último producto devuelto (su SKU, o [orden, SKU]) junto con los filtros de la consulta
+    payload = json.dumps({'After': position, 'Filters': list(filters)}).encode()
+    return base64.urlsafe_b64encode(payload).decode().rstrip('=')
+
+def decode_cursor(cursor, *filters):
+    try:
+        payload = json.loads(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)))
+    except (ValueError, TypeError):
+        return None
+    if not isinstance(payload, dict) or payload.get('Filters') != list(filters):
+        return None
+    return payload.get('After')
+
 @product_blueprint.route('/products/post', methods=['POST'])
 def create_product():
     """
@@ -61,46 +308,111 @@ def create_product():
         data = request.get_json()
 
         # Validaciones
-        if not data:
-            return make_response(json.dumps({"Message": "Request body cannot be empty"}, indent=1), 400, {'Content-Type': 'application/json'})
-        required_fields = ['Product', 'Description', 'Quantity', 'Brand', 'Department', 'Price']
-        for field in required_fields:
-            if field not in data:
-                return make_response(json.dumps({"Message": f"Missing field: {field}"}, indent=4), 400, {'Content-Type': 'application/json'})
-                
-        if not isinstance(data['Product'], str) or not re.match(regex, data['Product']):
-            return make_response(json.dumps({"Message": "Product name can only contain letters, numbers, and spaces"}, indent=4), 400, {'Content-Type': 'application/json'})
-        if not isinstance(data['Description'], str):
-            return make_response(json.dumps({"Message": "Description must be a string"}, indent=4), 400, {'Content-Type': 'application/json'})
-        if not isinstance(data['Quantity'], int) or data['Quantity'] < 0:
-            return make_response(json.dumps({'Message': "Quantity must be a non-negative integer"}, indent=4), 400, {'Content-Type': 'application/json'})
-        if not isinstance(data['Brand'], str) or not re.match(regex, data['Brand']):
-            return make_response(json.dumps({"Message": "Brand can only contain letters, numbers, and spaces"}, indent=4), 400, {'Content-Type': 'application/json'})
-        if not isinstance(data['Department'], str) or not re.match(regex, data['Department']):
-            return make_response(json.dumps({"Message": "Department can only contain letters, numbers, and spaces"}, indent=4), 400, {'Content-Type': 'application/json'})
-        if not isinstance(data['Price'], (int, float)) or data['Price'] < 0:
-            return make_response(json.dumps({"Message": 'Price must be a non-negative number'}, indent=4), 400, {'Content-Type': 'application/json'})
+        error = validate_product(data)
+        if error:
+            return make_response(json.dumps({"Message": error}, indent=4), 400, {'Content-Type': 'application/json'})
 
         # Crear el nuevo producto y su SKU
         new_product = Product(Product=data['Product'], Description=data['Description'], Quantity=data['Quantity'], Brand=data['Brand'], Department=data['Department'], Price=data['Price'])
         db.session.add(new_product)
+        apply_aggregate_deltas(after=[product_state(new_product)])
+        record_changes(CHANGE_UPSERT, [new_product.SKU])
         db.session.commit()
-        redis_client.delete("all_products")
-        clear_product_quantity_cache()
-
-        product_json = {
-            'SKU': new_product.SKU,
-            'Product': new_product.Product,
-            'Description': new_product.Description,
-            'Brand': new_product.Brand,
-            'Department': new_product.Department,
-            'Quantity': new_product.Quantity,
-            'Price': new_product.Price
-        }
-        return make_response(json.dumps({'message': 'Product created successfully', 'Product': product_json}, indent=4), 201, {'Content-Type': 'application/json'})
+        invalidate_products()
+
+        return json_response({'message': 'Product created successfully', 'Product': product_json(new_product)}, 201)
     except Exception as e:
         return make_response(json.dumps({'message': f'Product not created: {str(e)}'}, indent=4), 500, {'Content-Type': 'application/json'})
 
+@product_blueprint.route('/products/bulk', methods=['POST'])
+def create_products_bulk():
+    """
+    Create many products at once
+    ---
+    tags:
+      - Products
+    summary: Builds a batch of products
+    description: Validates every product in the array, allocates all SKUs together and inserts the whole batch in a single transaction. If any product is invalid nothing is inserted and the errors of each item are returned.
+    parameters:
+      - name: body
+        in: body
+        required: true
+        schema:
+          type: array
+          items:
+            type: object
+            required:
+              - Product
+              - Description
+              - Quantity
+              - Brand
+              - Department
+              - Price
+            properties:
+              Product:
+                type: string
+              Description:
+                type: string
+              Quantity:
+                type: integer
+              Brand:
+                type: string
+              Department:
+                type: string
+              Price:
+                type: number
+                format: float
+    responses:
+      201:
+        description: Products created successfully
+      400:
+        description: Invalid input, with the errors of each item
+      500:
+        description: Error creating products
+    """
+    try:
+        data = request.get_json()
+
+        # Validaciones
+        if not isinstance(data, list) or not data:
+            return make_response(json.dumps({"Message": "Request body must be a non-empty array of products"}, indent=4), 400, {'Content-Type': 'application/json'})
+        if len(data) > BULK_MAX_PRODUCTS:
+            return make_response(json.dumps({"Message": f"A batch cannot contain more than {BULK_MAX_PRODUCTS} products"}, indent=4), 400, {'Content-Type': 'application/json'})
+
+        errors = []
+        for index, item in enumerate(data):
+            error = validate_product(item)
+            if error:
+                errors.append({'Index': index, 'Error': error})
+        if errors:
+            return make_response(json.dumps({'Message': 'Invalid input', 'Errors': errors}, indent=4), 400, {'Content-Type': 'application/json'})
+
+        # Crear todos los SKU del lote e insertarlo en una sola transacción
+        skus = generate_skus([(item['Department'], item['Product'], item['Brand']) for item in data])
+        rows = [
+            {
+                'SKU': sku,
+                'Product': item['Product'],
+                'Description': item['Description'],
+                'Brand': item['Brand'],
+                'Department': item['Department'],
+                'Quantity': item['Quantity'],
+                'Price': item['Price']
+            }
+            for sku, item in zip(skus, data)
+        ]
+        for start in range(0, len(rows), BULK_INSERT_CHUNK):
+            db.session.execute(Product.__table__.insert(), rows[start:start + BULK_INSERT_CHUNK])
+        apply_aggregate_deltas(after=[product_state(row) for row in rows])
+        record_changes(CHANGE_UPSERT, skus)
+        db.session.commit()
+        invalidate_products()
+
+        return json_response({'message': 'Products created successfully', 'Products': rows}, 201)
+    except Exception as e:
+        db.session.rollback()
+        return make_response(json.dumps({'message': f'Products not created: {str(e)}'}, indent=4), 500, {'Content-Type': 'application/json'})
+
 @product_blueprint.route('/products/getall', methods=['GET'])
 def get_all_products():
     """
@@ -109,7 +421,18 @@ def get_all_products():
     tags:
       - Products
     summary: Get all products
-    description: Retrieve all products from the inventory. Returns all products or an error if there is an issue.
+    description: Retrieve all products from the inventory. Returns all products or an error if there is an issue. With stream=1 or an Accept header of application/x-ndjson the products are streamed one JSON object per line, read from the database in batches.
+    parameters:
+      - name: stream
+        in: query
+        type: boolean
+        required: false
+        description: "Stream the catalog as NDJSON instead of building a single JSON document"
+      - name: fields
+        in: query
+        type: string
+        required: false
+        description: "Comma-separated fields to return, for example SKU,Quantity,Price. SKU is always included. Only those columns are read and each projection is cached on its own"
     responses:
       200:
         description: List of all products
@@ -131,6 +454,8 @@ def get_all_products():
                   Brand: "Manufacturer D"
                   Department: "Section Z"
                   Price: 20.00
+      304:
+        description: Not modified since the ETag (If-None-Match) or date (If-Modified-Since) sent by the client
       500:
         description: Product not found or server error
         content:
@@ -140,30 +465,137 @@ def get_all_products():
               Error: "Description of the error"
     """
     try:
-        cached_products = redis_client.get('all_products')
-        if cached_products:
-            products_data = json.loads(cached_products)
-            return make_response(json.dumps(products_data), 200, {'Content-Type': 'application/json'})
-        
-        products = Product.query.order_by(Product.SKU.asc()).all()
-        products_json = [ 
-            {
-                'SKU': product.SKU,
-                'Product': product.Product,
-                'Description': product.Description,
-                'Brand': product.Brand,
-                'Department' : product.Department,
-                'Quantity': product.Quantity,
-                'Price': product.Price
-            }
-            for product in products
-        ]
-        response = {'Products': products_json}
-        redis_client.setex('all_products', 3600, json.dumps(response))
-        return make_response(json.dumps(response), 200, {'Content-Type': 'application/json'})
+        fields, error = requested_fields()
+        if error:
+            return make_response(json.dumps({'Error': error}), 400, {'Content-Type': 'application/json'})
+
+        if request.args.get('stream', default='0').lower() in ('1', 'true', 'yes') or request.accept_mimetypes.best == 'application/x-ndjson':
+            return Response(stream_with_context(stream_products(fields)), 200, {'Content-Type': 'application/x-ndjson'})
+
+        @uses_database
+        def build():
+            products = read_session().query(*product_columns(fields)).order_by(Product.SKU.asc()).all()
+            return pack({'Products': [product_json(product, fields) for product in products]})
+
+        if not CACHE_ALL_PRODUCTS:
+            return conditional_response(cached_response(build()))
+        return listing_response('all_products', namespace_key('all_products', *projection_key(fields)), build, ALL_PRODUCTS_CACHE)
     except Exception as e:
         return make_response(json.dumps({'message': f'Product not created: {str(e)}'}, indent=4), 500, {'Content-Type': 'application/json'})
 
+@product_blueprint.route('/products/changes', methods=['GET'])
+def get_product_changes():
+    """
+    Incremental change feed
+    ---
+    tags:
+      - Products
+    summary: Products created, updated or deleted after a token
+    description: Returns the changes recorded after the given token, oldest first, with a next_token for the following call. Each SKU appears once per page with its latest change. Upserts carry the current product. To start syncing, call with since=now to get the current token, download the catalog (/products/export), and then follow the feed from that token.
+    parameters:
+      - name: since
+        in: query
+        type: string
+        required: false
+        description: "next_token of the previous call, or now for the current position. Without it the feed starts at the oldest change kept"
+      - name: limit
+        in: query
+        type: integer
+        required: false
+        description: "Maximum number of log entries read (default 100, max 1000)"
+    responses:
+      200:
+        description: Changes, next_token and has_more
+      400:
+        description: Invalid token or limit
+      410:
+        description: The token is older than the changes kept; download the catalog again and restart with since=now
+      500:
+        description: Error retrieving changes
+    """
+    try:
+        since = request.args.get('since')
+        limit = request.args.get('limit', default=100, type=int)
+        if limit <= 0 or limit > CHANGES_MAX_LIMIT:
+            return make_response(json.dumps({'Error': f'limit must be between 1 and {CHANGES_MAX_LIMIT}'}), 400, {'Content-Type': 'application/json'})
+
+        # El feed se lee siempre de la base principal: una réplica con retraso podría saltarse cambios
+        if since == 'now':
+            return json_response({'Changes': [], 'next_token': encode_cursor([change_feed_head(), 0], 'changes'), 'has_more': False})
+
+        after = (0, 0)
+        if since:
+            position = decode_cursor(since, 'changes')
+            if not isinstance(position, list) or len(position) != 2 or not all(isinstance(value, int) for value in position):
+                return make_response(json.dumps({'Error': 'Invalid token'}), 400, {'Content-Type': 'application/json'})
+            after = tuple(position)
+            horizon = change_feed_horizon()
+            if horizon and after < horizon:
+                return make_response(json.dumps({'Error': 'Token expired, download the catalog again and restart with since=now'}), 410, {'Content-Type': 'application/json'})
+
+        rows = read_changes(after, limit + 1)
+        has_more = len(rows) > limit
+        rows = rows[:limit]
+
+        # Solo el último cambio de cada SKU dentro de la página
+        latest = {}
+        for row in rows:
+            latest.pop(row.ChangedSKU, None)
+            latest[row.ChangedSKU] = row
+        changes = []
+        for row in latest.values():
+            if row.Operation == CHANGE_DELETE:
+                changes.append({'Operation': CHANGE_DELETE, 'SKU': row.ChangedSKU})
+            elif row.SKU is not None:
+                # Un alta de un producto borrado después se omite: su baja llega más adelante en el feed
+                changes.append({'Operation': CHANGE_UPSERT, 'SKU': row.ChangedSKU, 'Product': product_json(row)})
+
+        next_token = encode_cursor([rows[-1].TxId, rows[-1].Id], 'changes') if rows else encode_cursor(list(after), 'changes')
+        return json_response({'Changes': changes, 'next_token': next_token, 'has_more': has_more})
+    except Exception as e:
+        return make_response(json.dumps({'message': f'Changes not retrieved: {str(e)}'}, indent=4), 500, {'Content-Type': 'application/json'})
+
+@product_blueprint.route('/products/export', methods=['GET'])
+def export_all_products():
+    """
+    Export the whole catalog
+    ---
+    tags:
+      - Products
+    summary: Download every product as CSV or Parquet
+    description: Streams the products table, ordered by SKU, through a server-side cursor in fixed-size batches, so memory use does not grow with the catalog. It never reads or writes the cache. Parquet needs pyarrow installed on the server.
+    produces:
+      - text/csv
+      - application/vnd.apache.parquet
+    parameters:
+      - name: format
+        in: query
+        type: string
+        enum: [csv, parquet]
+        default: csv
+        required: false
+        description: "File format of the export"
+    responses:
+      200:
+        description: The catalog file, sent as it is read
+      400:
+        description: Unknown format, or Parquet requested without pyarrow
+      500:
+        description: Error exporting products
+    """
+    try:
+        export_format = request.args.get('format', default='csv').lower()
+        if export_format not in available_formats():
+            return make_response(json.dumps({"Message": f"format must be one of: {', '.join(available_formats())}"}, indent=4), 400, {'Content-Type': 'application/json'})
+
+        details = EXPORT_FORMATS[export_format]
+        return Response(stream_with_context(export_products(export_format)), 200, {
+            'Content-Type': details['mimetype'],
+            'Content-Disposition': f"attachment; filename=products.{details['extension']}"
+        })
+    except Exception as e:
+        return make_response(json.dumps({'message': f'Products not exported: {str(e)}'}, indent=4), 500, {'Content-Type': 'application/json'})
+
 @product_blueprint.route('/products/getbyquantity/', methods=['GET'])
 def get_products_byQuantity():
     """
@@ -189,9 +621,28 @@ def get_products_byQuantity():
         type: integer
         required: false
         description: "Number of items per page"
+      - name: cursor
+        in: query
+        type: string
+        required: false
+        description: "next_cursor returned by the previous page. When present, page is ignored and deep pages cost the same as the first one"
+      - name: count
+        in: query
+        type: boolean
+        required: false
+        description: "Include the total number of matching products (default true). Turn it off to skip the COUNT query"
+      - name: fields
+        in: query
+        type: string
+        required: false
+        description: "Comma-separated fields to return, for example SKU,Quantity,Price. SKU is always included. Only those columns are read and each projection is cached on its own"
     responses:
       200:
-        description: List of products
+        description: List of products, with next_cursor when there are more pages
+      304:
+        description: Not modified since the ETag (If-None-Match) or date (If-Modified-Since) sent by the client
+      400:
+        description: Invalid parameters or cursor
       500:
         description: Error retrieving products
     """
@@ -199,48 +650,257 @@ def get_products_byQuantity():
         quantity = request.args.get('quantity', default=0, type=int)
         page = request.args.get('page', default=1, type=int)
         per_page = request.args.get('per_page', default=10, type=int)
+        cursor = request.args.get('cursor')
+        with_count = request.args.get('count', default='true').lower() not in ('0', 'false', 'no')
+        fields, error = requested_fields()
 
         #Validaciones
+        if error:
+            return make_response(json.dumps({'Error': error}), 400, {'Content-Type': 'application/json'})
         if quantity < 0:
             return make_response(json.dumps({'Error': 'The provided quantity must be greater than zero'}), 400, {'Content-Type': 'application/json'})
         
         if page <= 0 or per_page <= 0:
             return make_response(json.dumps({'Error': 'Page and per_page must be greater than zero'}), 400, {'Content-Type': 'application/json'})
 
-        # Comprobar el caché de Redis
-        cache_key = f'products_quantity_{quantity}_{page}_{per_page}'
-        cached_products = redis_client.get(cache_key)
+        last_sku = None
+        if cursor:
+            last_sku = decode_cursor(cursor, quantity)
+            if not isinstance(last_sku, str):
+                return make_response(json.dumps({'Error': 'Invalid cursor'}), 400, {'Content-Type': 'application/json'})
 
-        if cached_products:
-            products_data = json.loads(cached_products)
-            return make_response(json.dumps(products_data), 200, {'Content-Type': 'application/json'})
+        @uses_database
+        def build():
+            # Filtro, orden y límite se ejecutan en Postgres (índice ix_products_quantity_sku)
+            query = read_session().query(*product_columns(fields)).filter(Product.Quantity >= quantity)
+            page_query = query.filter(Product.SKU > last_sku) if last_sku else query
+            page_query = page_query.order_by(Product.SKU.asc()).limit(per_page + 1)
+            paginated_products = (page_query if last_sku else page_query.offset((page - 1) * per_page)).all()
 
-        products = Product.query.filter(Product.Quantity >= quantity).order_by(Product.SKU.asc()).all()
-        start_index = (page -1) * per_page
-        end_index = start_index + per_page
-        paginated_products = products[start_index:end_index]
+            has_more = len(paginated_products) > per_page
+            paginated_products = paginated_products[:per_page]
 
-        products_json = [
-            {
-                'SKU': product.SKU,
-                'Product': product.Product,
-                'Description': product.Description,
-                'Brand': product.Brand,
-                'Department': product.Department,
-                'Quantity': product.Quantity,
-                'Price': product.Price
-            }
-            for product in paginated_products
-        ]
-        
-        # Almacenar en caché
-        response = {'Products': products_json}
-        redis_client.setex(cache_key, 3600, json.dumps(response))
+            response = {'Products': [product_json(product, fields) for product in paginated_products]}
+            if with_count:
+                response['Total'] = query.count()
+            response['next_cursor'] = encode_cursor(paginated_products[-1].SKU, quantity) if has_more else None
+            return pack(response)
 
-        return make_response(json.dumps(response), 200, {'Content-Type': 'application/json'})
+        # Comprobar el caché de Redis
+        position = f'c{cursor}' if cursor else page
+        cache_key = namespace_key('products_quantity', quantity, position, per_page, int(with_count), *projection_key(fields))
+        return listing_response('products_quantity', cache_key, build, PRODUCTS_QUANTITY_CACHE)
     except Exception as e:
         return make_response(json.dumps({'message': f'Product not retrieved: {str(e)}'}, indent=4), 500, {'Content-Type': 'application/json'})
 
+@product_blueprint.route('/products/search', methods=['GET'])
+def search_products():
+    """
+    Search products by text
+    ---
+    tags:
+      - Products
+    summary: Full-text search over the catalog
+    description: Searches the name, brand, department and description of the products, ranked by relevance (matches in the name weigh the most). Uses keyset pagination through next_cursor.
+    parameters:
+      - name: q
+        in: query
+        type: string
+        required: true
+        description: "Text to search. Supports quoted phrases, OR and -word"
+      - name: per_page
+        in: query
+        type: integer
+        required: false
+        description: "Number of items per page (max 100)"
+      - name: cursor
+        in: query
+        type: string
+        required: false
+        description: "next_cursor returned by the previous page"
+    responses:
+      200:
+        description: Matching products, best match first, with next_cursor when there are more pages
+      304:
+        description: Not modified since the ETag (If-None-Match) or date (If-Modified-Since) sent by the client
+      400:
+        description: Invalid parameters or cursor
+      500:
+        description: Error searching products
+    """
+    try:
+        q = ' '.join(request.args.get('q', default='').split())
+        per_page = request.args.get('per_page', default=10, type=int)
+        cursor = request.args.get('cursor')
+
+        #Validaciones
+        if not q:
+            return make_response(json.dumps({'Error': 'The search text q cannot be empty'}), 400, {'Content-Type': 'application/json'})
+        if per_page <= 0 or per_page > SEARCH_MAX_PER_PAGE:
+            return make_response(json.dumps({'Error': f'per_page must be between 1 and {SEARCH_MAX_PER_PAGE}'}), 400, {'Content-Type': 'application/json'})
+
+        after = None
+        if cursor:
+            after = decode_cursor(cursor, q)
+            if not (isinstance(after, list) and len(after) == 2 and isinstance(after[0], float) and isinstance(after[1], str)):
+                return make_response(json.dumps({'Error': 'Invalid cursor'}), 400, {'Content-Type': 'application/json'})
+
+        @uses_database
+        def build():
+            # Índice GIN ix_products_search sobre la columna generada search_vector
+            tsquery = db.func.websearch_to_tsquery(SEARCH_CONFIG, q)
+            rank = db.cast(db.func.ts_rank_cd(Product.search_vector, tsquery), db.Float)
+            query = read_session().query(Product, rank).filter(Product.search_vector.op('@@')(tsquery))
+            if after:
+                query = query.filter(db.or_(rank < after[0], db.and_(rank == after[0], Product.SKU > after[1])))
+            results = query.order_by(rank.desc(), Product.SKU.asc()).limit(per_page + 1).all()
+
+            has_more = len(results) > per_page
+            results = results[:per_page]
+
+            response = {'Products': [product_json(product) for product, _ in results]}
+            response['next_cursor'] = encode_cursor([results[-1][1], results[-1][0].SKU], q) if has_more else None
+            return pack(response)
+
+        # Comprobar el caché de Redis (la búsqueda normalizada se guarda como hash)
+        signature = hashlib.sha1(f'{q.lower()}|{cursor or ""}|{per_page}'.encode()).hexdigest()
+        return listing_response('products_search', namespace_key('products_search', signature), build, PRODUCTS_SEARCH_CACHE)
+    except Exception as e:
+        return make_response(json.dumps({'message': f'Products not searched: {str(e)}'}, indent=4), 500, {'Content-Type': 'application/json'})
+
+@product_blueprint.route('/products/query', methods=['GET'])
+def query_products():
+    """
+    Filter and sort products
+    ---
+    tags:
+      - Products
+    summary: Fetches products matching several filters, in the chosen order
+    description: Combines department, brand, price range and quantity range filters with a sort field into one indexed SQL query. Only the listed parameters are accepted. Uses keyset pagination through next_cursor.
+    parameters:
+      - name: department
+        in: query
+        type: string
+        required: false
+        description: "Exact department name"
+      - name: brand
+        in: query
+        type: string
+        required: false
+        description: "Exact brand name"
+      - name: min_price
+        in: query
+        type: number
+        required: false
+        description: "Minimum price (inclusive)"
+      - name: max_price
+        in: query
+        type: number
+        required: false
+        description: "Maximum price (inclusive)"
+      - name: min_quantity
+        in: query
+        type: integer
+        required: false
+        description: "Minimum quantity (inclusive)"
+      - name: max_quantity
+        in: query
+        type: integer
+        required: false
+        description: "Maximum quantity (inclusive)"
+      - name: sort
+        in: query
+        type: string
+        enum: [SKU, Quantity, Price]
+        required: false
+        description: "Sort field (default SKU). Ties are broken by SKU"
+      - name: order
+        in: query
+        type: string
+        enum: [asc, desc]
+        required: false
+        description: "Sort direction (default asc)"
+      - name: per_page
+        in: query
+        type: integer
+        required: false
+        description: "Number of items per page (max 100)"
+      - name: cursor
+        in: query
+        type: string
+        required: false
+        description: "next_cursor returned by the previous page. It is only valid for the same filters and sort"
+      - name: fields
+        in: query
+        type: string
+        required: false
+        description: "Comma-separated fields to return, for example SKU,Quantity,Price. SKU is always included"
+    responses:
+      200:
+        description: Matching products, with next_cursor when there are more pages
+      304:
+        description: Not modified since the ETag (If-None-Match) or date (If-Modified-Since) sent by the client
+      400:
+        description: Unknown or invalid parameters, or invalid cursor
+      500:
+        description: Error retrieving products
+    """
+    try:
+        spec, error = parse_product_query()
+        if error:
+            return make_response(json.dumps({'Error': error}), 400, {'Content-Type': 'application/json'})
+        fields, error = requested_fields()
+        if error:
+            return make_response(json.dumps({'Error': error}), 400, {'Content-Type': 'application/json'})
+
+        filters, sort, per_page = spec['Filters'], spec['Sort'], spec['PerPage']
+        descending = spec['Order'] == 'desc'
+        # Firma normalizada: el mismo filtro escrito de otra forma (orden de parámetros, mayúsculas en sort) comparte caché
+        signature = json.dumps([filters, sort, spec['Order']], sort_keys=True)
+
+        cursor = request.args.get('cursor')
+        after = None
+        if cursor:
+            after = decode_cursor(cursor, signature)
+            kind = {'SKU': str, 'Quantity': int, 'Price': (int, float)}[sort]
+            if not (isinstance(after, list) and len(after) == 2 and isinstance(after[0], kind) and not isinstance(after[0], bool) and isinstance(after[1], str)):
+                return make_response(json.dumps({'Error': 'Invalid cursor'}), 400, {'Content-Type': 'application/json'})
+
+        @uses_database
+        def build():
+            # Una sola consulta: filtros, orden por (campo, SKU) y límite en Postgres, con índices
+            # (Department, Quantity, SKU), (Brand, Price, SKU), (Price, SKU) y (Quantity, SKU)
+            sort_column = getattr(Product, sort)
+            columns = product_columns(fields) + ([] if sort in fields else [sort_column])
+            query = read_session().query(*columns)
+            for name, value in filters.items():
+                field, compare, _ = QUERY_FILTERS[name]
+                query = query.filter(compare(getattr(Product, field), value))
+
+            if sort == 'SKU':
+                if after:
+                    query = query.filter(Product.SKU < after[1] if descending else Product.SKU > after[1])
+                order_by = [Product.SKU.desc() if descending else Product.SKU.asc()]
+            else:
+                if after:
+                    position, last = db.tuple_(sort_column, Product.SKU), db.tuple_(*after)
+                    query = query.filter(position < last if descending else position > last)
+                order_by = [sort_column.desc(), Product.SKU.desc()] if descending else [sort_column.asc(), Product.SKU.asc()]
+            results = query.order_by(*order_by).limit(per_page + 1).all()
+
+            has_more = len(results) > per_page
+            results = results[:per_page]
+
+            response = {'Products': [product_json(product, fields) for product in results]}
+            response['next_cursor'] = encode_cursor([getattr(results[-1], sort), results[-1].SKU], signature) if has_more else None
+            return pack(response)
+
+        # Comprobar el caché de Redis (la consulta normalizada se guarda como hash)
+        key = hashlib.sha1(f'{signature}|{cursor or ""}|{per_page}|{".".join(fields)}'.encode()).hexdigest()
+        return listing_response('products_query', namespace_key('products_query', key), build, PRODUCTS_QUERY_CACHE)
+    except Exception as e:
+        return make_response(json.dumps({'message': f'Products not retrieved: {str(e)}'}, indent=4), 500, {'Content-Type': 'application/json'})
+
 @product_blueprint.route('/products/getby/<string:SKU>', methods=['GET'])
 def get_product(SKU):
     """
@@ -256,42 +916,109 @@ def get_product(SKU):
         type: string
         required: true
         description: "SKU of the product to search"
+      - name: fields
+        in: query
+        type: string
+        required: false
+        description: "Comma-separated fields to return, for example SKU,Quantity,Price. SKU is always included. Only those columns are read and each projection is cached on its own"
     responses:
       200:
         description: Product found
+      304:
+        description: Not modified since the ETag (If-None-Match) or date (If-Modified-Since) sent by the client
       404:
         description: Product not found
       500:
         description: Error retrieving product
     """
     try:
-        # Comprobar el caché de Redis
-        cache_key = f'product_{SKU}'
-        cached_product = redis_client.get(cache_key)
+        fields, error = requested_fields()
+        if error:
+            return make_response(json.dumps({'Error': error}), 400, {'Content-Type': 'application/json'})
 
-        if cached_product:
-            product_data = json.loads(cached_product)
-            return make_response(json.dumps(product_data), 200, {'Content-Type': 'application/json'})
+        @uses_database
+        def build():
+            product = read_session().query(*product_columns(fields), Product.UpdatedAt).filter(Product.SKU == SKU).first()
+            return (pack({'Product': product_json(product, fields)}), product.UpdatedAt.timestamp()) if product else None
 
-        product = Product.query.filter_by(SKU=SKU).first()
-        if product:
-            product_json = {
-                'SKU': product.SKU,
-                'Product': product.Product,
-                'Description': product.Description,
-                'Brand': product.Brand,
-                'Department': product.Department,
-                'Quantity': product.Quantity,
-                'Price': product.Price
-            }
-            # Almacenar en caché
-            redis_client.setex(cache_key, 3600, json.dumps({'Product': product_json}))
-            return make_response(json.dumps({'Product': product_json}), 200, {'Content-Type': 'application/json'})
+        # Comprobar el caché de Redis; las proyecciones se invalidan juntas con la familia product_fields
+        cache_key = f'product_{SKU}' if fields == PRODUCT_FIELDS else namespace_key('product_fields', *projection_key(fields), SKU)
+        entry = cached_fetch(cache_key, build, PRODUCT_CACHE)
+        if entry is not None:
+            return conditional_response(entry)
         
         return make_response(json.dumps({'Message': 'Product not found'}, indent=4), 404, {'Content-Type': 'application/json'})
     except Exception as e:
         return make_response(json.dumps({'message': f'Product not created: {str(e)}'}, indent=4), 500, {'Content-Type': 'application/json'})
     
+@product_blueprint.route('/products/getmany', methods=['GET', 'POST'])
+def get_many_products():
+    """
+    Get many products by SKU
+    ---
+    tags:
+      - Products
+    summary: Gets several products in one request
+    description: Returns the products that match the SKUs provided, in the same order. SKUs can be sent as repeated sku query parameters or, with POST, as a JSON array. Cached products are read with a single MGET and the rest with a single query. SKUs that do not exist are returned with a not found message.
+    parameters:
+      - name: sku
+        in: query
+        type: array
+        items:
+          type: string
+        collectionFormat: multi
+        required: false
+        description: "SKUs of the products to search"
+      - name: body
+        in: body
+        required: false
+        schema:
+          type: array
+          items:
+            type: string
+    responses:
+      200:
+        description: Products in request order, with a not found marker for missing SKUs
+      400:
+        description: No SKUs or too many SKUs
+      500:
+        description: Error retrieving products
+    """
+    try:
+        skus = request.args.getlist('sku')
+        if request.method == 'POST':
+            skus = request.get_json(silent=True)
+        if not isinstance(skus, list) or not skus or not all(isinstance(sku, str) for sku in skus):
+            return make_response(json.dumps({'Message': 'Invalid input', 'Error': 'Provide a non-empty list of SKUs'}, indent=4), 400, {'Content-Type': 'application/json'})
+        if len(skus) > GETMANY_MAX_SKUS:
+            return make_response(json.dumps({'Message': 'Invalid input', 'Error': f'No more than {GETMANY_MAX_SKUS} SKUs per request'}, indent=4), 400, {'Content-Type': 'application/json'})
+
+        unique_skus = list(dict.fromkeys(skus))
+        products = {}
+
+        # Comprobar el caché de Redis con un solo MGET; las entradas caducadas se recargan junto con las que faltan
+        for sku, entry in zip(unique_skus, cache_get_many([f'product_{sku}' for sku in unique_skus])):
+            response = unpack_entry(entry) if entry is not None else None
+            if response is not None and response.fresh_until >= time.time():
+                products[sku] = loads(response.body)['Product']
+
+        misses = [sku for sku in unique_skus if sku not in products]
+        @uses_database
+        def load(skus):
+            return read_session().query(Product).filter(Product.SKU.in_(skus)).all()
+
+        if misses:
+            results = {}
+            for product in load(misses):
+                products[product.SKU] = product_json(product)
+                results[f'product_{product.SKU}'] = (pack({'Product': products[product.SKU]}), product.UpdatedAt.timestamp())
+            if results and not replica_read_stale():
+                cache_set_many(results, PRODUCT_CACHE)
+
+        return json_response({'Products': [products.get(sku) or {'SKU': sku, 'Message': 'Product not found'} for sku in skus]})
+    except Exception as e:
+        return make_response(json.dumps({'message': f'Products not retrieved: {str(e)}'}, indent=4), 500, {'Content-Type': 'application/json'})
+
 @product_blueprint.route('/products/put/<string:SKU>', methods=['PUT'])
 def update_product(SKU):
     """
@@ -350,7 +1077,7 @@ def update_product(SKU):
     
     try:
       #Validaciones
-        product = Product.query.filter_by(SKU=SKU).first()
+        product = Product.query.filter_by(SKU=SKU).with_for_update().first()
         if not product:
           return make_response(json.dumps({'Message': 'Product not found'}, indent=4), 404, {'Content-Type': 'application/json'})
       
@@ -379,31 +1106,133 @@ def update_product(SKU):
             return make_response(json.dumps({'Message': 'Invalid input', 'Error': "Department can only contain letters, numbers, and spaces"}, indent=4), 400, {'Content-Type': 'application/json'})
         
         
+        before = product_state(product)
         product.Product = data['Product']
         product.Description = data['Description']
         product.Quantity = data['Quantity']
         product.Brand = data['Brand']
         product.Department = data['Department']
         product.Price = data['Price']
+        apply_aggregate_deltas(before=[before], after=[product_state(product)])
+        record_changes(CHANGE_UPSERT, [SKU])
         db.session.commit()
             
-        redis_client.delete(f"product_{SKU}")
-        redis_client.delete("all_products")
-        clear_product_quantity_cache()
-
-        product_json = {
-          'SKU': product.SKU,
-          'Product': product.Product,
-          'Description': product.Description,
-          'Brand': product.Brand,
-          'Department': product.Department,
-          'Quantity': product.Quantity,
-          'Price': product.Price
-        }
-        return make_response(json.dumps({'Message': 'Product updated', 'Product': product_json}, indent=4), 200, {'Content-Type': 'application/json'})
+        invalidate_products(SKU)
+
+        return json_response({'Message': 'Product updated', 'Product': product_json(product)})
     except Exception as e:
         return make_response(json.dumps({'message': f'Product not created: {str(e)}'}, indent=4), 500, {'Content-Type': 'application/json'})
 
+@product_blueprint.route('/products/<string:SKU>/adjust', methods=['POST'])
+def adjust_product(SKU):
+    """
+    Adjust the stock of a product
+    ---
+    tags:
+      - Products
+    summary: Adds or removes stock atomically
+    description: Adds a signed delta to the quantity of the product in a single statement, so concurrent adjustments never overwrite each other. The quantity can never become negative.
+    parameters:
+      - name: SKU
+        in: path
+        type: string
+        required: true
+        description: "SKU of the product"
+      - name: body
+        in: body
+        required: true
+        schema:
+          type: object
+          required:
+            - Delta
+          properties:
+            Delta:
+              type: integer
+              description: "Units to add (positive) or remove (negative)"
+    responses:
+      200:
+        description: Stock adjusted
+      400:
+        description: Invalid input
+      404:
+        description: Product not found
+      409:
+        description: Not enough stock to remove
+      500:
+        description: Error adjusting stock
+    """
+    try:
+        data = request.get_json(silent=True)
+        if not isinstance(data, dict) or not valid_delta(data.get('Delta')):
+            return make_response(json.dumps({'Message': 'Invalid input', 'Error': f'Delta must be an integer between {-QUANTITY_MAX} and {QUANTITY_MAX}'}, indent=4), 400, {'Content-Type': 'application/json'})
+
+        updated, failures = adjust_stock({SKU: data['Delta']})
+        if SKU in failures:
+            status = {'Insufficient stock': 409, 'Quantity out of range': 400}.get(failures[SKU], 404)
+            return make_response(json.dumps({'Message': failures[SKU]}, indent=4), status, {'Content-Type': 'application/json'})
+        return json_response({'Message': 'Stock adjusted', 'Product': product_json(updated[SKU])})
+    except Exception as e:
+        db.session.rollback()
+        return make_response(json.dumps({'message': f'Stock not adjusted: {str(e)}'}, indent=4), 500, {'Content-Type': 'application/json'})
+
+@product_blueprint.route('/products/adjust', methods=['POST'])
+def adjust_products():
+    """
+    Adjust the stock of many products
+    ---
+    tags:
+      - Products
+    summary: Adds or removes stock of many products atomically
+    description: Applies every (SKU, Delta) pair with a single UPDATE statement. Deltas for the same SKU are added together. Adjustments that would leave a negative quantity, or whose SKU does not exist, are skipped and reported.
+    parameters:
+      - name: body
+        in: body
+        required: true
+        schema:
+          type: array
+          items:
+            type: object
+            required:
+              - SKU
+              - Delta
+            properties:
+              SKU:
+                type: string
+              Delta:
+                type: integer
+    responses:
+      200:
+        description: Result of every SKU, with the new quantity or an error
+      400:
+        description: Invalid input
+      500:
+        description: Error adjusting stock
+    """
+    try:
+        data = request.get_json(silent=True)
+        if not isinstance(data, list) or not data:
+            return make_response(json.dumps({'Message': 'Invalid input', 'Error': 'Request body must be a non-empty array of adjustments'}, indent=4), 400, {'Content-Type': 'application/json'})
+        if len(data) > ADJUST_MAX_ITEMS:
+            return make_response(json.dumps({'Message': 'Invalid input', 'Error': f'No more than {ADJUST_MAX_ITEMS} adjustments per request'}, indent=4), 400, {'Content-Type': 'application/json'})
+
+        deltas = {}
+        for index, item in enumerate(data):
+            if not isinstance(item, dict) or not isinstance(item.get('SKU'), str) or not valid_delta(item.get('Delta')):
+                return make_response(json.dumps({'Message': 'Invalid input', 'Error': f'Item {index} must have a SKU string and an integer Delta between {-QUANTITY_MAX} and {QUANTITY_MAX}'}, indent=4), 400, {'Content-Type': 'application/json'})
+            deltas[item['SKU']] = deltas.get(item['SKU'], 0) + item['Delta']
+            if not valid_delta(deltas[item['SKU']]):
+                return make_response(json.dumps({'Message': 'Invalid input', 'Error': f"The Deltas of {item['SKU']} add up to more than {QUANTITY_MAX} in absolute value"}, indent=4), 400, {'Content-Type': 'application/json'})
+
+        updated, failures = adjust_stock(deltas)
+        results = [
+            {'SKU': sku, 'Quantity': updated[sku].Quantity} if sku in updated else {'SKU': sku, 'Error': failures[sku]}
+            for sku in deltas
+        ]
+        return json_response({'Results': results})
+    except Exception as e:
+        db.session.rollback()
+        return make_response(json.dumps({'message': f'Stock not adjusted: {str(e)}'}, indent=4), 500, {'Content-Type': 'application/json'})
+
 @product_blueprint.route('/products/delete/<string:SKU>', methods=['DELETE'])
 def delete_product(SKU):
     """
@@ -429,14 +1258,14 @@ def delete_product(SKU):
     """
 
     try:
-        product = Product.query.filter_by(SKU=SKU).first()
+        product = Product.query.filter_by(SKU=SKU).with_for_update().first()
         if product:
             db.session.delete(product)
+            apply_aggregate_deltas(before=[product_state(product)])
+            record_changes(CHANGE_DELETE, [SKU])
             db.session.commit()
             
-            redis_client.delete(f"product_{SKU}")
-            redis_client.delete("all_products")
-            clear_product_quantity_cache()
+            invalidate_products(SKU)
 
             return make_response(jsonify({'Message': 'Product deleted'}), 200)
         return make_response(jsonify({'Message': 'Product not deleted'}), 404)
@@ -493,7 +1322,7 @@ def patch_product(SKU):
     """
     
     try:
-        product = Product.query.filter_by(SKU=SKU).first()
+        product = Product.query.filter_by(SKU=SKU).with_for_update().first()
         if not product:
             return make_response(json.dumps({'Message': 'Product not found'}, indent=4), 404, {'Content-Type': 'application/json'})
         
@@ -501,10 +1330,11 @@ def patch_product(SKU):
         if not data:
             return make_response(json.dumps({'Message': 'Invalid input', 'Error': 'Request body is missing'}, indent=4), 400, {'Content-Type': 'application/json'})
         
+        before = product_state(product)
         if 'Product' in data:
             if not isinstance(data['Product'], str) or not re.match(regex, data['Product']):
                 return make_response(json.dumps({'Message': 'Invalid input', 'Error': 'Product name can only contain letters, numbers, and spaces'}, indent=4), 400, {'Content-Type': 'application/json'})
-            product.Name = data['Name']
+            product.Product = data['Product']
 
         if 'Description' in data:
             if not isinstance(data['Description'], str):
@@ -524,29 +1354,314 @@ def patch_product(SKU):
         if 'Brand' in data:
             if not isinstance(data['Brand'], str) or not re.match(regex, data['Brand']):
                 return make_response(json.dumps({'Message': 'Invalid input', 'Error': "Brand can only contain letters, numbers, and spaces"}, indent=4), 400, {'Content-Type': 'application/json'})
-            product.Price = data['Brand']
+            product.Brand = data['Brand']
 
         if 'Department' in data:
             if not isinstance(data['Department'], str) or not re.match(regex, data['Department']):
                 return make_response(json.dumps({'Message': 'Invalid input', 'Error': "Department can only contain letters, numbers, and spaces"}, indent=4), 400, {'Content-Type': 'application/json'})
-            product.Price = data['Brand']
+            product.Department = data['Department']
         
+        apply_aggregate_deltas(before=[before], after=[product_state(product)])
+        record_changes(CHANGE_UPSERT, [SKU])
         db.session.commit() 
 
-        redis_client.delete(f"product_{SKU}")
-        redis_client.delete("all_products")
-        clear_product_quantity_cache()
-
-        product_json = {
-            'SKU': product.SKU,
-            'Product': product.Product,
-            'Description': product.Description,
-            'Brand': product.Brand,
-            'Department': product.Department,
-            'Quantity': product.Quantity,
-            'Price': product.Price
-        }
-        return make_response(json.dumps({'Message': 'Product patched successfully', 'Product': product_json}, indent=4), 200, {'Content-Type': 'application/json'})
+        invalidate_products(SKU)
+
+        return json_response({'Message': 'Product patched successfully', 'Product': product_json(product)})
     except Exception as e:
         return make_response(json.dumps({'message': f'Product not created: {str(e)}'}, indent=4), 500, {'Content-Type': 'application/json'})
 
+@product_blueprint.route('/products/aggregates', methods=['GET'])
+def get_aggregates():
+    """
+    Inventory aggregates
+    ---
+    tags:
+      - Products
+    summary: Stock value, SKU count and low-stock count per department and brand
+    description: Returns the inventory summary kept up to date by every write, without scanning the products table. Stock value is the sum of Quantity times Price. A product is low on stock when its quantity is at or below LOW_STOCK_THRESHOLD.
+    parameters:
+      - name: dimension
+        in: query
+        type: string
+        enum: [Department, Brand]
+        required: false
+        description: "Return only one dimension"
+    responses:
+      200:
+        description: Aggregates grouped by dimension
+      400:
+        description: Unknown dimension
+      500:
+        description: Error retrieving the aggregates
+    """
+    try:
+        dimension = request.args.get('dimension')
+        if dimension is not None and dimension not in AGGREGATE_DIMENSIONS:
+            return make_response(json.dumps({'Error': f'dimension must be one of {", ".join(AGGREGATE_DIMENSIONS)}'}), 400, {'Content-Type': 'application/json'})
+
+        query = InventoryAggregate.query.filter(InventoryAggregate.SKUs > 0)
+        if dimension:
+            query = query.filter(InventoryAggregate.Dimension == dimension)
+
+        response = {'LowStockThreshold': LOW_STOCK_THRESHOLD}
+        for name in ((dimension,) if dimension else AGGREGATE_DIMENSIONS):
+            response[name] = []
+        for row in query.order_by(InventoryAggregate.Dimension, InventoryAggregate.Name).all():
+            response[row.Dimension].append({'Name': row.Name, 'SKUs': row.SKUs, 'StockValue': round(row.StockValue, 2), 'LowStock': row.LowStock})
+        return json_response(response)
+    except Exception as e:
+        return make_response(json.dumps({'message': f'Aggregates not retrieved: {str(e)}'}, indent=4), 500, {'Content-Type': 'application/json'})
+
+@product_blueprint.route('/products/snapshot', methods=['GET'])
+def get_snapshot_status():
+    """
+    Columnar snapshot status
+    ---
+    tags:
+      - Snapshot
+    summary: Version and staleness of the in-memory columnar snapshot
+    description: Reports the snapshot version shared by the workers, how long ago it was brought up to date, and how many changes in the change log it has not applied yet. The pending count is read from the database.
+    responses:
+      200:
+        description: Snapshot status, with a change feed token for its position
+      404:
+        description: The snapshot engine is disabled
+      500:
+        description: Error reading the snapshot
+    """
+    try:
+        if not snapshot_enabled():
+            return make_response(json.dumps({'Error': SNAPSHOT_DISABLED}), 404, {'Content-Type': 'application/json'})
+        snapshot = current_snapshot()
+        response = snapshot_info(snapshot)
+        response['BuiltAt'] = datetime.fromtimestamp(snapshot.meta['BuiltAt'], timezone.utc).isoformat()
+        response['CheckedAt'] = datetime.fromtimestamp(snapshot.meta['CheckedAt'], timezone.utc).isoformat()
+        response['PendingChanges'] = pending_changes(snapshot.meta['Position'])
+        response['ChangesToken'] = encode_cursor(snapshot.meta['Position'], 'changes')
+        return json_response(response)
+    except Exception as e:
+        return make_response(json.dumps({'message': f'Snapshot not read: {str(e)}'}, indent=4), 500, {'Content-Type': 'application/json'})
+
+@product_blueprint.route('/products/snapshot/getbyquantity/', methods=['GET'])
+def get_snapshot_byQuantity():
+    """
+    Get products by quantity from the snapshot
+    ---
+    tags:
+      - Snapshot
+    summary: Quantity, department and brand filters answered from the columnar snapshot
+    description: Same filter as /products/getbyquantity/, answered with vectorized scans over the snapshot instead of Postgres. Returns SKU, Quantity, Price, Department and Brand, sorted by SKU. The snapshot can be up to SNAPSHOT_MAX_AGE seconds behind the database; its age is returned in Snapshot.
+    parameters:
+      - name: quantity
+        in: query
+        type: integer
+        required: false
+        description: "Minimum quantity (inclusive)"
+      - name: max_quantity
+        in: query
+        type: integer
+        required: false
+        description: "Maximum quantity (inclusive)"
+      - name: department
+        in: query
+        type: string
+        required: false
+        description: "Exact department name"
+      - name: brand
+        in: query
+        type: string
+        required: false
+        description: "Exact brand name"
+      - name: per_page
+        in: query
+        type: integer
+        required: false
+        description: "Number of items per page (max 1000)"
+      - name: cursor
+        in: query
+        type: string
+        required: false
+        description: "next_cursor returned by the previous page"
+    responses:
+      200:
+        description: Matching products, the total and the snapshot age, with next_cursor when there are more pages
+      400:
+        description: Invalid parameters or cursor
+      404:
+        description: The snapshot engine is disabled
+      500:
+        description: Error reading the snapshot
+    """
+    try:
+        if not snapshot_enabled():
+            return make_response(json.dumps({'Error': SNAPSHOT_DISABLED}), 404, {'Content-Type': 'application/json'})
+        quantity = request.args.get('quantity', default=0, type=int)
+        max_quantity = request.args.get('max_quantity', type=int)
+        department = request.args.get('department')
+        brand = request.args.get('brand')
+        per_page = request.args.get('per_page', default=10, type=int)
+        cursor = request.args.get('cursor')
+
+        #Validaciones
+        if quantity < 0 or (max_quantity is not None and max_quantity < quantity):
+            return make_response(json.dumps({'Error': 'quantity must be non-negative and not greater than max_quantity'}), 400, {'Content-Type': 'application/json'})
+        if per_page <= 0 or per_page > SNAPSHOT_MAX_PER_PAGE:
+            return make_response(json.dumps({'Error': f'per_page must be between 1 and {SNAPSHOT_MAX_PER_PAGE}'}), 400, {'Content-Type': 'application/json'})
+        filters = ('snapshot', quantity, max_quantity, department, brand)
+        last_sku = None
+        if cursor:
+            last_sku = decode_cursor(cursor, *filters)
+            if not isinstance(last_sku, str):
+                return make_response(json.dumps({'Error': 'Invalid cursor'}), 400, {'Content-Type': 'application/json'})
+
+        # Sin Postgres ni Redis: las posiciones que cumplen los filtros salen de una pasada vectorizada
+        snapshot = current_snapshot()
+        positions = snapshot.matching(quantity, max_quantity, department, brand)
+        total = len(positions)
+        if last_sku:
+            positions = snapshot.after(positions, last_sku)
+        products = snapshot.rows(positions[:per_page])
+
+        response = {'Products': products, 'Total': total}
+        response['next_cursor'] = encode_cursor(products[-1]['SKU'], *filters) if len(positions) > per_page else None
+        response['Snapshot'] = snapshot_info(snapshot)
+        return json_response(response)
+    except Exception as e:
+        return make_response(json.dumps({'message': f'Product not retrieved: {str(e)}'}, indent=4), 500, {'Content-Type': 'application/json'})
+
+@product_blueprint.route('/products/snapshot/aggregates', methods=['GET'])
+def get_snapshot_aggregates():
+    """
+    Inventory aggregates from the snapshot
+    ---
+    tags:
+      - Snapshot
+    summary: Stock value, SKU count and low-stock count per department and brand, from the columnar snapshot
+    description: Same response as /products/aggregates, computed with vectorized group-bys over the snapshot. Unlike the stored aggregates, the low-stock threshold can be chosen per request.
+    parameters:
+      - name: dimension
+        in: query
+        type: string
+        enum: [Department, Brand]
+        required: false
+        description: "Return only one dimension"
+      - name: low_stock
+        in: query
+        type: integer
+        required: false
+        description: "Low-stock threshold (default LOW_STOCK_THRESHOLD)"
+    responses:
+      200:
+        description: Aggregates grouped by dimension, with the snapshot age
+      400:
+        description: Unknown dimension or invalid threshold
+      404:
+        description: The snapshot engine is disabled
+      500:
+        description: Error reading the snapshot
+    """
+    try:
+        if not snapshot_enabled():
+            return make_response(json.dumps({'Error': SNAPSHOT_DISABLED}), 404, {'Content-Type': 'application/json'})
+        dimension = request.args.get('dimension')
+        low_stock = request.args.get('low_stock', default=LOW_STOCK_THRESHOLD, type=int)
+        if dimension is not None and dimension not in AGGREGATE_DIMENSIONS:
+            return make_response(json.dumps({'Error': f'dimension must be one of {", ".join(AGGREGATE_DIMENSIONS)}'}), 400, {'Content-Type': 'application/json'})
+        if low_stock < 0:
+            return make_response(json.dumps({'Error': 'low_stock must be a non-negative integer'}), 400, {'Content-Type': 'application/json'})
+
+        snapshot = current_snapshot()
+        response = {'LowStockThreshold': low_stock}
+        for name in ((dimension,) if dimension else AGGREGATE_DIMENSIONS):
+            response[name] = snapshot.aggregates(name, low_stock)
+        response['Snapshot'] = snapshot_info(snapshot)
+        return json_response(response)
+    except Exception as e:
+        return make_response(json.dumps({'message': f'Aggregates not retrieved: {str(e)}'}, indent=4), 500, {'Content-Type': 'application/json'})
+
+@product_blueprint.route('/products/sku/usage', methods=['GET'])
+def get_sku_usage():
+    """
+    SKU usage by prefix
+    ---
+    tags:
+      - Products
+    summary: Shows how full each SKU prefix is
+    description: Returns, for every SKU prefix (first letter of the department, product and brand), how many products use it, the last SKU number reserved and the fraction of the prefix capacity already used.
+    responses:
+      200:
+        description: Usage of every SKU prefix
+      500:
+        description: Error retrieving the SKU usage
+    """
+    try:
+        return json_response({'Prefixes': sku_prefix_usage()})
+    except Exception as e:
+        return make_response(json.dumps({'message': f'SKU usage not retrieved: {str(e)}'}, indent=4), 500, {'Content-Type': 'application/json'})
+
+@product_blueprint.route('/db/pool', methods=['GET'])
+def get_pool_stats():
+    """
+    Database connection pool statistics
+    ---
+    tags:
+      - Database
+    summary: Shows the state of the connection pools of this worker
+    description: Returns, for the primary database and the read replica (when DB_READ_URL is set), the connections in use, how saturated the pool is, and how long requests waited to check out a connection.
+    responses:
+      200:
+        description: Pool counters per database
+    """
+    return json_response(pool_stats())
+
+@product_blueprint.route('/metrics', methods=['GET'])
+def get_metrics():
+    """
+    Prometheus metrics
+    ---
+    tags:
+      - Monitoring
+    summary: Exposes the service metrics in the Prometheus text format
+    description: Request latency and payload sizes per route, SQL statements and time per request, and cache hits, misses, sets and invalidations per key family.
+    produces:
+      - text/plain
+    responses:
+      200:
+        description: Metrics in the Prometheus exposition format
+    """
+    body, content_type = render_metrics()
+    return Response(body, 200, {'Content-Type': content_type})
+
+@product_blueprint.route('/cache/stats', methods=['GET'])
+def get_cache_stats():
+    """
+    In-process cache statistics
+    ---
+    tags:
+      - Cache
+    summary: Shows the counters of the in-process (L1) cache and the state of the Redis circuit breaker
+    description: Returns the size, hits, misses and evictions of the L1 cache of the worker that answers the request. L1 is disabled unless L1_CACHE_SIZE is set. Redis shows the circuit breaker of the worker (closed, open or half_open) and how many invalidations are waiting for Redis to come back.
+    responses:
+      200:
+        description: L1 cache counters, or Enabled false when it is disabled, and the Redis circuit breaker
+    """
+    stats = local_cache_stats()
+    response = {'Enabled': False} if stats is None else dict(stats, Enabled=True)
+    response['Redis'] = cache_stats()
+    return json_response(response)
+
+@product_blueprint.route('/admission/stats', methods=['GET'])
+def get_admission_stats():
+    """
+    Admission control settings
+    ---
+    tags:
+      - Admission
+    summary: Shows the rate limits and the database slots of the worker
+    description: Returns the token-bucket limits per route (requests per second and burst, for the whole route and for each client) and how many of the worker's database slots are in use. Admitted and shed requests are counted in /metrics as inventapi_admission_decisions_total.
+    responses:
+      200:
+        description: Admission control settings and in-flight requests
+    """
+    return json_response(admission_stats())
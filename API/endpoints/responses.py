@@ -0,0 +1,89 @@
+from flask import Response, make_response, request
+from werkzeug.http import http_date
+from os import environ
+import calendar, gzip, json
+
+# orjson es opcional: si no está instalado se usa json de la librería estándar
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# Los cuerpos guardados en Redis pueden ir comprimidos con gzip (CACHE_GZIP=1)
+CACHE_GZIP = environ.get('CACHE_GZIP', '0').lower() in ('1', 'true', 'yes')
+GZIP_MIN_SIZE = int(environ.get('GZIP_MIN_SIZE', 1024))
+GZIP_MAGIC = b'\x1f\x8b'
+
+def dumps(data):
+    if orjson is not None:
+        return orjson.dumps(data)
+    return json.dumps(data, separators=(',', ':')).encode()
+
+def loads(body):
+    if body[:2] == GZIP_MAGIC:
+        body = gzip.decompress(body)
+    if orjson is not None:
+        return orjson.loads(body)
+    return json.loads(body)
+
+PRODUCT_FIELDS = ('SKU', 'Product', 'Description', 'Brand', 'Department', 'Quantity', 'Price')
+
+def product_json(product, fields=PRODUCT_FIELDS):
+    # product puede ser un Product o una fila de una consulta por columnas
+    return {field: getattr(product, field) for field in fields}
+
+def pack(data):
+    # Bytes finales de la respuesta, listos para guardarse en Redis
+    body = dumps(data)
+    if CACHE_GZIP and len(body) >= GZIP_MIN_SIZE:
+        return gzip.compress(body, compresslevel=5)
+    return body
+
+def json_response(body, status=200):
+    # Devuelve el cuerpo tal cual; solo se descomprime si el cliente no acepta gzip
+    if not isinstance(body, bytes):
+        body = pack(body)
+    headers = {'Content-Type': 'application/json', 'Vary': 'Accept-Encoding'}
+    if body[:2] == GZIP_MAGIC:
+        if 'gzip' in request.accept_encodings:
+            headers['Content-Encoding'] = 'gzip'
+        else:
+            body = gzip.decompress(body)
+    return make_response(body, status, headers)
+
+def not_modified_response(headers):
+    # 304 sin cuerpo ni Content-Type, con el mismo Vary que la respuesta completa
+    response = Response(status=304, headers=headers)
+    response.headers.remove('Content-Type')
+    response.headers['Vary'] = 'Accept-Encoding'
+    return response
+
+def version_not_modified(etag):
+    # Sondeo de un listado con el ETag de su versión: 304 sin leer la entrada guardada.
+    # Se desconoce si el cuerpo guardado va comprimido, así que valen las dos variantes del ETag.
+    if etag is None or not request.if_none_match:
+        return None
+    for tag in (etag, etag + '-gzip'):
+        if request.if_none_match.contains(tag) and (tag == etag or 'gzip' in request.accept_encodings):
+            return not_modified_response({'ETag': f'"{tag}"', 'Cache-Control': 'no-cache'})
+    return None
+
+def conditional_response(entry, status=200):
+    # Respuesta guardada con su ETag y Last-Modified; 304 sin cuerpo si el cliente ya la tiene
+    # El ETag fuerte cambia según se envíe el cuerpo comprimido o no
+    etag = entry.etag + ('-gzip' if entry.body[:2] == GZIP_MAGIC and 'gzip' in request.accept_encodings else '')
+    headers = {'ETag': f'"{etag}"', 'Last-Modified': http_date(entry.last_modified), 'Cache-Control': 'no-cache'}
+    if request.if_none_match:
+        not_modified = request.if_none_match.star_tag or request.if_none_match.contains(etag)
+    elif request.if_modified_since and entry.last_modified <= entry.built_at - 1:
+        # Last-Modified solo tiene segundos: si la respuesta se construyó en el mismo segundo de la última modificación,
+        # otra escritura en ese segundo no cambiaría la fecha, así que solo vale el ETag
+        not_modified = int(entry.last_modified) <= calendar.timegm(request.if_modified_since.utctimetuple())
+    else:
+        not_modified = False
+
+    if not_modified:
+        return not_modified_response(headers)
+    response = json_response(entry.body, status)
+    response.headers.extend(headers)
+    return response
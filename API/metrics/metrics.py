@@ -0,0 +1,102 @@
+from flask import g, has_app_context, has_request_context, request
+from prometheus_client import CollectorRegistry, Counter, Gauge, Histogram, REGISTRY, CONTENT_TYPE_LATEST, generate_latest, multiprocess
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from os import environ
+import time
+
+# Con varios workers de gunicorn cada proceso escribe sus métricas en PROMETHEUS_MULTIPROC_DIR
+# y /metrics las suma; sin esa variable se exportan las del proceso que atiende la petición.
+MULTIPROCESS = bool(environ.get('PROMETHEUS_MULTIPROC_DIR'))
+
+SIZE_BUCKETS = (128, 512, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304, 16777216, 67108864)
+COUNT_BUCKETS = (0, 1, 2, 3, 5, 8, 13, 21, 50, 100)
+
+REQUEST_LATENCY = Histogram('inventapi_http_request_duration_seconds', 'Time spent handling a request', ['method', 'route', 'status'])
+REQUEST_SIZE = Histogram('inventapi_http_request_size_bytes', 'Size of the request bodies', ['method', 'route'], buckets=SIZE_BUCKETS)
+RESPONSE_SIZE = Histogram('inventapi_http_response_size_bytes', 'Size of the response bodies (streamed responses are not counted)', ['method', 'route'], buckets=SIZE_BUCKETS)
+
+DB_QUERIES = Histogram('inventapi_db_queries_per_request', 'SQL statements executed per request', ['route'], buckets=COUNT_BUCKETS)
+DB_REQUEST_TIME = Histogram('inventapi_db_request_duration_seconds', 'Time spent in SQL statements per request', ['route'])
+DB_QUERY_TIME = Histogram('inventapi_db_query_duration_seconds', 'Time spent in each SQL statement', ['route', 'status'])
+
+CACHE_OPERATIONS = Counter('inventapi_cache_operations_total', 'Cache reads, writes and invalidations', ['operation', 'family'])
+CACHE_KEYS_DELETED = Counter('inventapi_cache_keys_deleted_total', 'Keys deleted from Redis by invalidations', ['family'])
+CACHE_INVALIDATION_TIME = Histogram('inventapi_cache_invalidation_duration_seconds', 'Time spent invalidating cache entries', ['namespaces'])
+CACHE_BREAKER_TRANSITIONS = Counter('inventapi_cache_breaker_transitions_total', 'Changes of state of the Redis circuit breaker', ['state'])
+CACHE_INVALIDATIONS_PENDING = Gauge('inventapi_cache_invalidations_pending', 'Invalidations waiting for Redis to come back', multiprocess_mode='livesum')
+
+ADMISSION_DECISIONS = Counter('inventapi_admission_decisions_total', 'Requests admitted or shed by admission control', ['route', 'decision'])
+# En modo multiproceso se suman los workers vivos
+DB_REQUESTS_IN_FLIGHT = Gauge('inventapi_db_requests_in_flight', 'Requests holding a database slot', multiprocess_mode='livesum')
+
+def key_family(key):
+    # product_<SKU>, <familia>:<generación>:..., gen_<familia>
+    key = key.decode() if isinstance(key, bytes) else key
+    if key.startswith('gen_'):
+        return 'generation'
+    if ':' in key:
+        return key.split(':', 1)[0]
+    if key.startswith('product_'):
+        return 'product'
+    return key
+
+def count_cache(operation, key, amount=1):
+    CACHE_OPERATIONS.labels(operation, key_family(key)).inc(amount)
+
+def current_route():
+    if has_request_context():
+        return request.url_rule.rule if request.url_rule is not None else 'unmatched'
+    return 'background'
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('query_started', []).append(time.perf_counter())
+
+def record_query(conn, status):
+    elapsed = time.perf_counter() - conn.info['query_started'].pop()
+    DB_QUERY_TIME.labels(current_route(), status).observe(elapsed)
+    if has_app_context() and 'metrics_started' in g:
+        g.db_queries += 1
+        g.db_time += elapsed
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    record_query(conn, 'ok')
+
+@event.listens_for(Engine, 'handle_error')
+def handle_error(context):
+    # Una sentencia que falla no llega a after_cursor_execute: sin esto su marca de inicio se quedaría en la conexión
+    if context.connection is not None and context.connection.info.get('query_started'):
+        record_query(context.connection, 'error')
+
+def start_request_metrics():
+    g.metrics_started = time.perf_counter()
+    g.db_queries = 0
+    g.db_time = 0.0
+
+def record_request_metrics(response):
+    if 'metrics_started' not in g:
+        return response
+    route = current_route()
+    REQUEST_LATENCY.labels(request.method, route, response.status_code).observe(time.perf_counter() - g.metrics_started)
+    REQUEST_SIZE.labels(request.method, route).observe(request.content_length or 0)
+    if not response.is_streamed:
+        RESPONSE_SIZE.labels(request.method, route).observe(response.calculate_content_length() or 0)
+    DB_QUERIES.labels(route).observe(g.db_queries)
+    DB_REQUEST_TIME.labels(route).observe(g.db_time)
+    g.pop('metrics_started')
+    return response
+
+def record_failed_request(exception=None):
+    # Excepciones que no atrapó ningún endpoint: after_request no llega a ejecutarse
+    if exception is not None and 'metrics_started' in g:
+        REQUEST_LATENCY.labels(request.method, current_route(), 500).observe(time.perf_counter() - g.pop('metrics_started'))
+
+def render_metrics():
+    if MULTIPROCESS:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    return generate_latest(registry), CONTENT_TYPE_LATEST
@@ -1,4 +1,7 @@
-from API import app
+from API import create_app
 
+app = create_app()
+
+# Servidor de desarrollo. En producción: gunicorn -c gunicorn.conf.py app:app
 if __name__ == '__main__':
     app.run()
\ No newline at end of file
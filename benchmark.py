@@ -0,0 +1,346 @@
+"""Benchmark and load test for InventAPI.
+
+    python benchmark.py seed --products 100000 --reset
+    python benchmark.py run --url http://localhost:4000 --concurrency 16 --duration 20 --output after.json
+    python benchmark.py compare before.json after.json
+    python benchmark.py startup --runs 10
+
+seed and run import the API, so they need the same DB_URL and Redis as the server
+(inside Docker: docker compose exec InventAPI python benchmark.py ...).
+"""
+from datetime import datetime, timezone
+from urllib.parse import urlsplit
+import argparse, http.client, json, os, platform, random, subprocess, sys, threading, time
+
+DEPARTMENTS = ['Tools', 'Garden', 'Kitchen', 'Office', 'Sports', 'Toys', 'Electronics', 'Pets']
+BRANDS = ['Acme', 'Zeta', 'Nova', 'Orbit', 'Vertex', 'Lumen']
+NAMES = ['Hammer', 'Drill', 'Shovel', 'Kettle', 'Lamp', 'Ball', 'Cable', 'Stapler', 'Rake', 'Bowl', 'Mouse', 'Tent']
+WORDS = ['steel', 'wooden', 'red', 'blue', 'compact', 'heavy', 'duty', 'cordless', 'portable', 'classic', 'pro', 'mini']
+
+READ_SCENARIOS = ['getall', 'getbyquantity', 'getby']
+# Orden fijo: los DELETE borran los productos creados por los POST de la misma ejecución
+SCENARIOS = ['post'] + READ_SCENARIOS + ['put', 'patch', 'delete']
+
+def create_app():
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    from API import create_app
+    return create_app()
+
+def random_product(rng):
+    return {
+        'Product': f"{rng.choice(NAMES)} {rng.randint(1, 9999)}",
+        'Description': ' '.join(rng.sample(WORDS, 4)),
+        'Brand': rng.choice(BRANDS),
+        'Department': rng.choice(DEPARTMENTS),
+        'Quantity': rng.randint(0, 500),
+        'Price': round(rng.uniform(1, 500), 2)
+    }
+
+def seed(args):
+    app = create_app()
+    from API.database.db import db, Product, InventoryAggregate, generate_skus, apply_aggregate_deltas, product_state, record_changes, CHANGE_UPSERT, CHANGE_DELETE
+    from API.cache.cache import invalidate_products
+
+    rng = random.Random(args.seed)
+    with app.app_context():
+        if args.reset:
+            # Las bajas también van al registro de cambios, para que /products/changes y la copia columnar las vean
+            deleted = db.session.execute(Product.__table__.delete().returning(Product.SKU)).scalars().all()
+            db.session.query(InventoryAggregate).delete(synchronize_session=False)
+            record_changes(CHANGE_DELETE, deleted)
+            db.session.commit()
+
+        # Mismo camino que /products/bulk: SKUs por lote, inserción por bloques, agregados por deltas y registro de cambios
+        started = time.perf_counter()
+        for start in range(0, args.products, args.batch):
+            items = [random_product(rng) for _ in range(min(args.batch, args.products - start))]
+            skus = generate_skus([(item['Department'], item['Product'], item['Brand']) for item in items])
+            rows = [dict(item, SKU=sku) for sku, item in zip(skus, items)]
+            db.session.execute(Product.__table__.insert(), rows)
+            apply_aggregate_deltas(after=[product_state(row) for row in rows])
+            record_changes(CHANGE_UPSERT, skus)
+            db.session.commit()
+            print(f"Seeded {start + len(rows)}/{args.products} products", file=sys.stderr)
+        invalidate_products()
+
+        total = db.session.query(db.func.count(Product.SKU)).scalar()
+    print(json.dumps({'Seeded': args.products, 'Total': total, 'Seconds': round(time.perf_counter() - started, 2)}))
+
+def percentile(latencies, fraction):
+    if not latencies:
+        return None
+    return round(latencies[min(len(latencies) - 1, int(round(fraction * (len(latencies) - 1))))] * 1000, 3)
+
+def summarize(latencies, errors, elapsed):
+    latencies.sort()
+    return {
+        'Requests': len(latencies),
+        'Errors': errors,
+        'Seconds': round(elapsed, 3),
+        'Throughput': round(len(latencies) / elapsed, 2) if elapsed else 0,
+        'MeanMs': round(sum(latencies) / len(latencies) * 1000, 3) if latencies else None,
+        'P50Ms': percentile(latencies, 0.50),
+        'P95Ms': percentile(latencies, 0.95),
+        'P99Ms': percentile(latencies, 0.99),
+        'MaxMs': round(latencies[-1] * 1000, 3) if latencies else None
+    }
+
+class Target:
+    """One keep-alive HTTP connection per worker thread."""
+
+    def __init__(self, url, timeout):
+        parts = urlsplit(url)
+        self.connection_class = http.client.HTTPSConnection if parts.scheme == 'https' else http.client.HTTPConnection
+        self.netloc = parts.netloc
+        self.base = parts.path.rstrip('/')
+        self.timeout = timeout
+        self.local = threading.local()
+
+    def request(self, method, path, body=None):
+        connection = getattr(self.local, 'connection', None)
+        if connection is None:
+            connection = self.local.connection = self.connection_class(self.netloc, timeout=self.timeout)
+        headers = {'Accept-Encoding': 'gzip'}
+        if body is not None:
+            body = json.dumps(body)
+            headers['Content-Type'] = 'application/json'
+        try:
+            connection.request(method, self.base + path, body=body, headers=headers)
+            response = connection.getresponse()
+            return response.status, response.read()
+        except Exception:
+            connection.close()
+            self.local.connection = None
+            raise
+
+def drive(target, next_request, concurrency, duration, prepare=None):
+    """Runs next_request() from `concurrency` threads for `duration` seconds.
+
+    next_request returns (method, path, body, on_success) or None when there is nothing
+    left to send; prepare, if given, runs before each request and is not timed.
+    """
+    lock = threading.Lock()
+    latencies, errors = [], [0]
+    deadline = time.perf_counter() + duration
+
+    def worker():
+        own = []
+        while time.perf_counter() < deadline:
+            with lock:
+                item = next_request()
+            if item is None:
+                break
+            method, path, body, on_success = item
+            if prepare:
+                prepare(path)
+            started = time.perf_counter()
+            try:
+                status, content = target.request(method, path, body)
+            except Exception:
+                status, content = None, b''
+            elapsed = time.perf_counter() - started
+            if status is None or status >= 400:
+                with lock:
+                    errors[0] += 1
+                continue
+            own.append(elapsed)
+            if on_success:
+                with lock:
+                    on_success(content)
+        with lock:
+            latencies.extend(own)
+
+    started = time.perf_counter()
+    threads = [threading.Thread(target=worker) for _ in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return summarize(latencies, errors[0], time.perf_counter() - started)
+
+def run(args):
+    app = create_app()
+    from API.database.db import db, Product
+    from API.cache.cache import invalidate_products
+
+    rng = random.Random(args.seed)
+    with app.app_context():
+        total = db.session.query(db.func.count(Product.SKU)).scalar()
+        sample = [row.SKU for row in db.session.query(Product.SKU).order_by(db.func.random()).limit(args.sample).all()]
+    if not sample:
+        raise SystemExit('The database has no products, run: python benchmark.py seed --products N')
+
+    target = Target(args.url, args.timeout)
+    scenarios = [name for name in SCENARIOS if name in args.scenarios]
+    # Las lecturas con la caché caliente se limitan a un conjunto fijo de claves que se calienta antes de medir
+    pages = [(rng.randint(0, 500), rng.randint(1, 20)) for _ in range(len(sample))]
+    keys = {
+        ('getall', 'cold'): [None], ('getall', 'warm'): [None],
+        ('getby', 'cold'): sample, ('getby', 'warm'): sample[:args.warm_keys],
+        ('getbyquantity', 'cold'): pages, ('getbyquantity', 'warm'): pages[:args.warm_keys]
+    }
+    created, mutable = [], list(sample)
+
+    def read_request(name, keys):
+        if name == 'getall':
+            return lambda: ('GET', '/products/getall', None, None)
+        if name == 'getbyquantity':
+            return lambda: ('GET', '/products/getbyquantity/?quantity={}&page={}&per_page=20'.format(*rng.choice(keys)), None, None)
+        return lambda: ('GET', f"/products/getby/{rng.choice(keys)}", None, None)
+
+    def cold_prepare(path):
+        # Cada petición fría empieza sin nada en Redis para su clave
+        if path.startswith('/products/getby/'):
+            invalidate_products(path.rsplit('/', 1)[-1])
+        else:
+            invalidate_products()
+
+    def write_request(name):
+        if name == 'post':
+            return lambda: ('POST', '/products/post', random_product(rng), lambda content: created.append(json.loads(content)['Product']['SKU']))
+        if name == 'put':
+            return lambda: ('PUT', f"/products/put/{rng.choice(mutable)}", random_product(rng), None)
+        if name == 'patch':
+            return lambda: ('PATCH', f"/products/patch/{rng.choice(mutable)}", {'Quantity': rng.randint(0, 500), 'Price': round(rng.uniform(1, 500), 2)}, None)
+        return lambda: ('DELETE', f"/products/delete/{created.pop()}", None, None) if created else None
+
+    results = {}
+    for name in scenarios:
+        if name in READ_SCENARIOS:
+            for cache in args.cache:
+                next_request = read_request(name, keys[name, cache])
+                if cache == 'warm':
+                    invalidate_products()
+                    for key in keys[name, cache]:
+                        method, path, _, _ = read_request(name, [key])()
+                        target.request(method, path)
+                print(f"Running {name}.{cache}", file=sys.stderr)
+                results[f"{name}.{cache}"] = drive(target, next_request, args.concurrency, args.duration, cold_prepare if cache == 'cold' else None)
+        else:
+            print(f"Running {name}", file=sys.stderr)
+            results[name] = drive(target, write_request(name), args.concurrency, args.duration)
+
+    report = {
+        'Meta': {
+            'Timestamp': datetime.now(timezone.utc).isoformat(),
+            'Commit': git_commit(),
+            'Url': args.url,
+            'Products': total,
+            'Concurrency': args.concurrency,
+            'Duration': args.duration,
+            'Seed': args.seed,
+            'Python': platform.python_version(),
+            'Host': platform.node()
+        },
+        'Results': results
+    }
+    output = json.dumps(report, indent=4)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+    print(output)
+
+# Se ejecuta en un proceso nuevo en cada medición, como un worker recién creado
+STARTUP_PROBE = """
+import json, sys, time
+started = time.perf_counter()
+from API import create_app
+app = create_app()
+timings = {'ImportMs': (time.perf_counter() - started) * 1000}
+client = app.test_client()
+for path in sys.argv[1:]:
+    started = time.perf_counter()
+    client.get(path)
+    timings[path] = (time.perf_counter() - started) * 1000
+print(json.dumps(timings))
+"""
+
+def startup(args):
+    root = os.path.dirname(os.path.abspath(__file__))
+    samples = []
+    for _ in range(args.runs):
+        output = subprocess.check_output([sys.executable, '-c', STARTUP_PROBE] + args.paths, cwd=root)
+        samples.append(json.loads(output.decode().strip().splitlines()[-1]))
+
+    results = {}
+    for name in samples[0]:
+        values = sorted(sample[name] for sample in samples)
+        results[name] = {'MedianMs': round(values[len(values) // 2], 1), 'MinMs': round(values[0], 1), 'MaxMs': round(values[-1], 1)}
+    print(json.dumps({'Runs': args.runs, 'Commit': git_commit(), 'Results': results}, indent=4))
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], stderr=subprocess.DEVNULL, cwd=os.path.dirname(os.path.abspath(__file__))).decode().strip()
+    except Exception:
+        return None
+
+def change(before, after):
+    if not before or after is None:
+        return ''
+    return f"{(after - before) / before * 100:+.1f}%"
+
+def compare(args):
+    with open(args.before) as f:
+        before = json.load(f)
+    with open(args.after) as f:
+        after = json.load(f)
+
+    print(f"{'Scenario':<22}{'Throughput':>31}{'P95 ms':>31}{'P99 ms':>31}")
+    regressions = []
+    for name in sorted(set(before['Results']) | set(after['Results'])):
+        old, new = before['Results'].get(name), after['Results'].get(name)
+        if not old or not new:
+            print(f"{name:<22}{'only in one run':>22}")
+            continue
+        columns = []
+        for field in ('Throughput', 'P95Ms', 'P99Ms'):
+            columns.append(f"{old[field]!s:>10} -> {new[field]!s:<8}{change(old[field], new[field]):>9}")
+        print(f"{name:<22}" + ''.join(columns))
+        if old['Throughput'] and (old['Throughput'] - new['Throughput']) / old['Throughput'] * 100 > args.threshold:
+            regressions.append(name)
+
+    if regressions:
+        print(f"Throughput dropped more than {args.threshold}% in: {', '.join(regressions)}")
+        raise SystemExit(1)
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark and load test for InventAPI')
+    commands = parser.add_subparsers(dest='command')
+    commands.required = True
+
+    seed_parser = commands.add_parser('seed', help='Insert N random products through the model layer')
+    seed_parser.add_argument('--products', type=int, default=10000)
+    seed_parser.add_argument('--batch', type=int, default=10000)
+    seed_parser.add_argument('--reset', action='store_true', help='Delete every product and aggregate first')
+    seed_parser.add_argument('--seed', type=int, default=42)
+    seed_parser.set_defaults(handler=seed)
+
+    run_parser = commands.add_parser('run', help='Drive every route and write throughput and latency percentiles')
+    run_parser.add_argument('--url', default='http://localhost:4000')
+    run_parser.add_argument('--concurrency', type=int, default=8)
+    run_parser.add_argument('--duration', type=float, default=10, help='Seconds per scenario')
+    run_parser.add_argument('--scenarios', nargs='+', choices=SCENARIOS, default=SCENARIOS)
+    run_parser.add_argument('--cache', nargs='+', choices=['cold', 'warm'], default=['cold', 'warm'])
+    run_parser.add_argument('--sample', type=int, default=10000, help='Existing SKUs used by reads, PUT and PATCH')
+    run_parser.add_argument('--warm-keys', type=int, default=200, help='Distinct keys read with a warm cache')
+    run_parser.add_argument('--timeout', type=float, default=60)
+    run_parser.add_argument('--seed', type=int, default=42)
+    run_parser.add_argument('--output', help='Write the JSON report to this file')
+    run_parser.set_defaults(handler=run)
+
+    startup_parser = commands.add_parser('startup', help='Measure import and first-request times of a new process')
+    startup_parser.add_argument('--runs', type=int, default=5)
+    startup_parser.add_argument('--paths', nargs='+', default=['/products/getbyquantity/?quantity=0', '/apispec_1.json'], help='Requests made in order after the import')
+    startup_parser.set_defaults(handler=startup)
+
+    compare_parser = commands.add_parser('compare', help='Compare two reports')
+    compare_parser.add_argument('before')
+    compare_parser.add_argument('after')
+    compare_parser.add_argument('--threshold', type=float, default=10, help='Exit with 1 if throughput drops more than this percent')
+    compare_parser.set_defaults(handler=compare)
+
+    args = parser.parse_args()
+    args.handler(args)
+
+if __name__ == '__main__':
+    main()
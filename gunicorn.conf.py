@@ -0,0 +1,61 @@
+# Configuración de gunicorn para producción: gunicorn -c gunicorn.conf.py app:app
+# Todos los valores se pueden cambiar con variables de entorno.
+from os import environ
+import multiprocessing, tempfile
+
+bind = environ.get('GUNICORN_BIND', '0.0.0.0:4000')
+
+# sync: un proceso por petición. gthread: hilos dentro de cada proceso. gevent: corrutinas (pip install gevent psycogreen)
+worker_class = environ.get('GUNICORN_WORKER_CLASS', 'gthread')
+workers = int(environ.get('GUNICORN_WORKERS', multiprocessing.cpu_count() * 2 + 1))
+threads = int(environ.get('GUNICORN_THREADS', 4))
+worker_connections = int(environ.get('GUNICORN_WORKER_CONNECTIONS', 1000))
+
+keepalive = int(environ.get('GUNICORN_KEEPALIVE', 5))
+timeout = int(environ.get('GUNICORN_TIMEOUT', 30))
+graceful_timeout = int(environ.get('GUNICORN_GRACEFUL_TIMEOUT', 30))
+
+# Reciclar workers cada cierto número de peticiones para acotar fugas de memoria
+max_requests = int(environ.get('GUNICORN_MAX_REQUESTS', 10000))
+max_requests_jitter = int(environ.get('GUNICORN_MAX_REQUESTS_JITTER', 1000))
+
+# Con preload la aplicación se importa una vez en el master y los workers la heredan al hacer fork (no usar con gevent)
+preload_app = environ.get('GUNICORN_PRELOAD', '0').lower() in ('1', 'true', 'yes')
+
+accesslog = environ.get('GUNICORN_ACCESS_LOG', '-')
+errorlog = '-'
+loglevel = environ.get('GUNICORN_LOG_LEVEL', 'info')
+
+# Los workers escriben sus métricas de Prometheus en un directorio común para que /metrics las sume.
+# Si no se indica uno, cada arranque usa un directorio nuevo y vacío.
+if not environ.get('PROMETHEUS_MULTIPROC_DIR'):
+    environ['PROMETHEUS_MULTIPROC_DIR'] = tempfile.mkdtemp(prefix='inventapi-metrics-')
+
+def post_fork(server, worker):
+    # Con preload las conexiones se abrieron en el master y no se pueden compartir entre procesos:
+    # cada worker descarta las heredadas y abre las suyas. Sin preload la aplicación aún no se ha creado.
+    if not server.cfg.preload_app:
+        return
+    # close=False: los sockets heredados siguen siendo del master; el worker solo olvida el pool y abre conexiones nuevas
+    app = server.app.wsgi()
+    from API import db
+    from API.cache.cache import redis_client, pubsub_client
+    with app.app_context():
+        db.engine.dispose(close=False)
+        for bind in (app.config.get('SQLALCHEMY_BINDS') or {}):
+            db.get_engine(app, bind).dispose(close=False)
+    redis_client.connection_pool.reset()
+    pubsub_client.connection_pool.reset()
+
+def post_worker_init(worker):
+    # gevent ya parcheó la librería estándar; psycopg2 necesita psycogreen para no bloquear el worker
+    if worker_class == 'gevent':
+        try:
+            from psycogreen.gevent import patch_psycopg
+            patch_psycopg()
+        except ImportError:
+            worker.log.warning('psycogreen is not installed: database calls will block the gevent worker')
+
+def child_exit(server, worker):
+    from prometheus_client import multiprocess
+    multiprocess.mark_process_dead(worker.pid)
@@ -0,0 +1,38 @@
+"""products table
+
+Revision ID: 0001
+Revises:
+Create Date: 2026-10-17 00:00:00
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '0001'
+down_revision = None
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Las bases creadas antes con db.create_all() ya tienen la tabla
+    if sa.inspect(op.get_bind()).has_table('products'):
+        return
+    op.create_table(
+        'products',
+        sa.Column('SKU', sa.String(length=9), nullable=False),
+        sa.Column('Product', sa.String(length=80), nullable=False),
+        sa.Column('Description', sa.String(length=1500), nullable=False),
+        sa.Column('Brand', sa.String(length=80), nullable=False),
+        sa.Column('Department', sa.String(length=90), nullable=False),
+        sa.Column('Quantity', sa.Integer(), nullable=False),
+        sa.Column('Price', sa.Float(), nullable=False),
+        sa.PrimaryKeyConstraint('SKU'),
+        sa.UniqueConstraint('SKU')
+    )
+
+
+def downgrade():
+    op.drop_table('products')
@@ -0,0 +1,60 @@
+"""UpdatedAt, search vector, quantity index and inventory aggregates
+
+Revision ID: 0002
+Revises: 0001
+Create Date: 2026-10-17 00:00:00
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+
+# revision identifiers, used by Alembic.
+revision = '0002'
+down_revision = '0001'
+branch_labels = None
+depends_on = None
+
+SEARCH_VECTOR = (
+    "setweight(to_tsvector('simple', \"Product\"), 'A') || "
+    "setweight(to_tsvector('simple', \"Brand\"), 'B') || "
+    "setweight(to_tsvector('simple', \"Department\"), 'B') || "
+    "setweight(to_tsvector('simple', \"Description\"), 'C')"
+)
+
+
+def upgrade():
+    # Cada paso se salta si ya existe, para las bases creadas con db.create_all() por versiones anteriores
+    inspector = sa.inspect(op.get_bind())
+    columns = {column['name'] for column in inspector.get_columns('products')}
+    indexes = {index['name'] for index in inspector.get_indexes('products')}
+
+    if 'UpdatedAt' not in columns:
+        op.add_column('products', sa.Column('UpdatedAt', sa.DateTime(timezone=True), server_default=sa.text('now()'), nullable=False))
+    if 'search_vector' not in columns:
+        op.add_column('products', sa.Column('search_vector', postgresql.TSVECTOR(), sa.Computed(SEARCH_VECTOR, persisted=True), nullable=True))
+    if 'ix_products_quantity_sku' not in indexes:
+        op.create_index('ix_products_quantity_sku', 'products', ['Quantity', 'SKU'], unique=False)
+    if 'ix_products_search' not in indexes:
+        op.create_index('ix_products_search', 'products', ['search_vector'], unique=False, postgresql_using='gin')
+
+    # Tabla nueva: se llena con flask reconcile-aggregates --fix
+    if not inspector.has_table('inventory_aggregates'):
+        op.create_table(
+            'inventory_aggregates',
+            sa.Column('Dimension', sa.String(length=20), nullable=False),
+            sa.Column('Name', sa.String(length=90), nullable=False),
+            sa.Column('SKUs', sa.Integer(), nullable=False),
+            sa.Column('StockValue', sa.Float(), nullable=False),
+            sa.Column('LowStock', sa.Integer(), nullable=False),
+            sa.PrimaryKeyConstraint('Dimension', 'Name')
+        )
+
+
+def downgrade():
+    op.drop_table('inventory_aggregates')
+    op.drop_index('ix_products_search', table_name='products')
+    op.drop_index('ix_products_quantity_sku', table_name='products')
+    op.drop_column('products', 'search_vector')
+    op.drop_column('products', 'UpdatedAt')
@@ -0,0 +1,44 @@
+"""product change log
+
+Revision ID: 0003
+Revises: 0002
+Create Date: 2026-10-17 00:00:00
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '0003'
+down_revision = '0002'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        'product_changes',
+        sa.Column('Id', sa.BigInteger(), nullable=False),
+        sa.Column('TxId', sa.BigInteger(), server_default=sa.text('txid_current()'), nullable=False),
+        sa.Column('SKU', sa.String(length=9), nullable=False),
+        sa.Column('Operation', sa.String(length=6), nullable=False),
+        sa.Column('ChangedAt', sa.DateTime(timezone=True), server_default=sa.text('now()'), nullable=False),
+        sa.PrimaryKeyConstraint('Id')
+    )
+    op.create_index('ix_product_changes_position', 'product_changes', ['TxId', 'Id'], unique=False)
+    op.create_index('ix_product_changes_sku', 'product_changes', ['SKU'], unique=False)
+    op.create_table(
+        'product_changes_horizon',
+        sa.Column('Id', sa.Integer(), nullable=False),
+        sa.Column('TxId', sa.BigInteger(), nullable=False),
+        sa.Column('ChangeId', sa.BigInteger(), nullable=False),
+        sa.PrimaryKeyConstraint('Id')
+    )
+
+
+def downgrade():
+    op.drop_table('product_changes_horizon')
+    op.drop_index('ix_product_changes_sku', table_name='product_changes')
+    op.drop_index('ix_product_changes_position', table_name='product_changes')
+    op.drop_table('product_changes')
@@ -0,0 +1,37 @@
+"""composite indexes for /products/query
+
+Revision ID: 0004
+Revises: 0003
+Create Date: 2026-10-17 00:00:00
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '0004'
+down_revision = '0003'
+branch_labels = None
+depends_on = None
+
+INDEXES = (
+    ('ix_products_department_quantity', ['Department', 'Quantity', 'SKU']),
+    ('ix_products_brand_price', ['Brand', 'Price', 'SKU']),
+    ('ix_products_price_sku', ['Price', 'SKU'])
+)
+
+
+def upgrade():
+    # CONCURRENTLY no bloquea las escrituras mientras se construye el índice, pero no puede ir dentro de una transacción
+    existing = {index['name'] for index in sa.inspect(op.get_bind()).get_indexes('products')}
+    with op.get_context().autocommit_block():
+        for name, columns in INDEXES:
+            if name not in existing:
+                op.create_index(name, 'products', columns, unique=False, postgresql_concurrently=True)
+
+
+def downgrade():
+    with op.get_context().autocommit_block():
+        for name, _ in reversed(INDEXES):
+            op.drop_index(name, table_name='products', postgresql_concurrently=True)